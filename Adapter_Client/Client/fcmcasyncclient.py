@@ -0,0 +1,401 @@
+import asyncio
+import pickle
+import time
+import numpy as np
+from fcmclimits import FCMCLimits, FCMCLimitError
+
+#tcp info
+TCP_ADDRESS = 'localhost'
+TCP_PORT = 1234
+HEADER_LENGTH = 10
+
+#default timeout for a request/response exchange in s
+TIMEOUT = 5.0
+
+#default time in s after which a silent peer is considered dead
+HEARTBEAT_TIMEOUT = 0.5
+
+#channel of every request type: frames are tagged with a correlation id and their channel,
+#so requests of different channels can be in flight at the same time
+CHANNELS = {'umr': 'motion', 'scv': 'query', 'bpe': 'query', 'sub': 'subscription', 'icc': 'subscription',
+            'ses': 'control', 'res': 'control', 'hb': 'control', 'stop': 'control'}
+
+class AsyncFCMCClient:
+    '''asyncio TCP client to connect with FCMC server
+
+    usage:
+        async with AsyncFCMCClient(address, port) as fcmc:
+            machAxes = await fcmc.get_act_values(machAxes)
+            fcmc.send_values(machAxes)'''
+
+    def __init__(self, address=TCP_ADDRESS, port=TCP_PORT, timeout=TIMEOUT) -> None:
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+
+        self.reader = None
+        self.writer = None
+
+        #every request is tagged with a correlation id: the reading task resolves the future
+        #of the request (and calls its progress callback) when a frame with its id arrives.
+        #Late answers of requests that timed out or were cancelled are discarded
+        self._next_id = 0
+        self._futures = {}
+        self._progress = {}
+        self._reading = None
+
+        #latest serialized update that was not sent yet and the task sending it
+        self._pending = None
+        self._sender = None
+        self._sender_error = None
+
+        #session token for a fast resumption after a reconnect, the negotiated heartbeat timeout,
+        #the task sending the heartbeats and an optional callback that is called when the server is dead.
+        #The server is dead if no frame arrived for longer than the heartbeat timeout
+        self.token = None
+        self.heartbeat_timeout = None
+        self._heartbeat = None
+        self._t_last_frame = 0.0
+        self._t_last_sent = 0.0
+        self.alive = False
+        self.on_dead = None
+
+        #soft limits configured in the machine axes, built from the first request
+        self.limits = None
+
+        #overlapping pairs reported by the server's interference detection
+        #and an optional callback that is called with the pairs when they change
+        self.interference = []
+        self.on_interference = None
+
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+#-----------------------------------private methods-------------------------------------------
+    def _encodeMessage(self, msg):
+        '''serialize a message and prepend the fixed length header'''
+        myMsg = pickle.dumps(msg)
+        return f"{len(myMsg) :< {HEADER_LENGTH}}".encode("utf-8") + myMsg
+
+
+    async def _recvMessage(self):
+        '''receive one complete message from fcmc server'''
+        message_header = await self.reader.readexactly(HEADER_LENGTH)
+        message_length = int(message_header.decode("utf-8").strip())
+        return pickle.loads(await self.reader.readexactly(message_length))
+
+
+    async def _readAnswers(self):
+        '''reading task: route every frame to the request with its correlation id'''
+        try:
+            while True:
+                message = await self._recvMessage()
+                self._t_last_frame = time.monotonic()
+                if not isinstance(message, dict):
+                    continue
+
+                req_id = message.pop('id', None)
+                message.pop('ch', None)
+
+                if message.get('type') == 'prg':
+                    progress = self._progress.get(req_id)
+                    if progress is not None:
+                        progress(message['done'], message['total'])
+                    continue
+
+                future = self._futures.get(req_id)
+                if future is not None and not future.done():
+                    future.set_result(message)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            #the server closed the connection
+            self._markDead()
+
+        finally:
+            #nothing will be answered any more
+            for future in self._futures.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("connection to the FCMC server lost"))
+
+
+    def _encodeRequest(self, request):
+        '''tag a request with a new correlation id and the channel of its type and serialize it,
+        returns the id and the encoded request'''
+        self._next_id += 1
+        return self._next_id, self._encodeMessage(dict(request, id=self._next_id, ch=CHANNELS[request['type']]))
+
+
+    async def _exchange(self, encoded, timeout, progress=None):
+        '''send an encoded request (id, data) and wait for the answer with its id'''
+        req_id, data = encoded
+
+        future = asyncio.get_running_loop().create_future()
+        self._futures[req_id] = future
+        if progress is not None:
+            self._progress[req_id] = progress
+
+        try:
+            self.writer.write(data)
+            self._t_last_sent = time.monotonic()
+            await asyncio.wait_for(self.writer.drain(), self._timeout(timeout))
+            return await asyncio.wait_for(future, self._timeout(timeout))
+        finally:
+            del self._futures[req_id]
+            self._progress.pop(req_id, None)
+
+
+    def _timeout(self, timeout):
+        '''timeout of an exchange: the given one or the client's default'''
+        return self.timeout if timeout is None else timeout
+
+
+    def _checkAnswer(self, message):
+        '''raise errors reported by the server and pick up interference reports'''
+        if not isinstance(message, dict):
+            return message
+
+        if message.get('type') == 'err':
+            if message['error'] == 'limits':
+                raise FCMCLimitError(message['violations'], "server rejected setpoint")
+            raise RuntimeError("FCMC server error: %s" % message['error'])
+
+        if 'interference' in message:
+            self.interference = message['interference']
+            if self.on_interference is not None:
+                self.on_interference(self.interference)
+
+        return message
+
+
+    async def _sendPending(self):
+        '''sender task: send the latest pending update until nothing is left'''
+        try:
+            while self._pending is not None:
+                encoded, self._pending = self._pending, None
+                self._checkAnswer(await self._exchange(encoded, None))
+        except Exception as e:
+            #remember the error to report it with the next call
+            self._sender_error = e
+
+            #an update that is not acknowledged in time means the server is stalled
+            if isinstance(e, asyncio.TimeoutError):
+                self._markDead()
+
+
+    async def _sendHeartbeats(self):
+        '''heartbeat task: keep the connection alive and detect a dead server. The server is dead once no frame
+        arrived for longer than the heartbeat timeout, whether requests are running or not: answers, progress
+        frames and the answers to the heartbeats all count'''
+        interval = self.heartbeat_timeout / 3
+        self._t_last_frame = time.monotonic()
+
+        try:
+            while self.alive:
+                await asyncio.sleep(interval)
+
+                if time.monotonic() - self._t_last_frame > self.heartbeat_timeout:
+                    self._markDead()
+                    break
+
+                #the server expects a frame at least once per heartbeat timeout: beat if nothing else was sent.
+                #The answer is not awaited, the reading task takes it as a sign of life and discards it
+                if time.monotonic() - self._t_last_sent >= interval:
+                    self.writer.write(self._encodeRequest({'type': 'hb'})[1])
+                    self._t_last_sent = time.monotonic()
+
+        except ConnectionError:
+            self._markDead()
+
+
+    def _markDead(self):
+        '''the connection is lost: report it once'''
+        if self.alive:
+            self.alive = False
+            if self.on_dead is not None:
+                self.on_dead()
+
+
+#-----------------------------------public methods-------------------------------------------
+    async def connect(self):
+        '''open the connection to the fcmc server'''
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port), self.timeout)
+        self.alive = True
+
+        self._reading = asyncio.ensure_future(self._readAnswers())
+
+
+    async def close(self):
+        '''cancel the pending update and close the connection'''
+        for task in (self._sender, self._reading, self._heartbeat):
+            if task is not None and not task.done():
+                task.cancel()
+        self._pending = None
+        self.alive = False
+
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.writer = None
+
+
+    async def get_act_values(self, machAxes, timeout=None):
+        '''get the actual CAD model axis positions from the server (Send Current Values, scv)'''
+        #the model may have been moved by someone else: build the limits and forget their history
+        self.limits = FCMCLimits(machAxes)
+
+        return self._checkAnswer(await self._exchange(self._encodeRequest(dict(machAxes, type='scv')), timeout))
+
+
+    def send_values(self, targetVals, t=None):
+        '''send target values to the server without waiting (Update Model Request, umr).
+        Updates that are issued while the server is still busy are coalesced: only the latest is sent.
+        t is the time of the setpoint in s (default: now). Raises FCMCLimitError if the values
+        violate the configured soft limits, ConnectionError once the server is dead'''
+        if self._sender_error is not None:
+            error, self._sender_error = self._sender_error, None
+            raise error
+
+        #a dead server would only queue the update
+        if not self.alive:
+            raise ConnectionError("connection to the FCMC server lost")
+
+        #check the soft limits before anything is sent
+        t = time.monotonic() if t is None else t
+        if self.limits is None:
+            self.limits = FCMCLimits(targetVals)
+        if self.limits:
+            violations = self.limits.check(targetVals, t)
+            if violations:
+                raise FCMCLimitError(violations)
+
+        #serialize right away, so the caller may keep modifying targetVals
+        self._pending = self._encodeRequest(dict(targetVals, type='umr', t=t))
+
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.ensure_future(self._sendPending())
+
+
+    async def flush(self, timeout=None):
+        '''wait until the latest update was acknowledged by the server'''
+        if self._sender is not None:
+            await asyncio.wait_for(asyncio.shield(self._sender), self._timeout(timeout))
+
+        if self._sender_error is not None:
+            error, self._sender_error = self._sender_error, None
+            raise error
+
+
+    async def subscribe(self, machAxes, interval=0.1, timeout=None):
+        '''async iterator of the actual CAD model axis positions, queried every interval seconds'''
+        loop = asyncio.get_running_loop()
+
+        while True:
+            t_next = loop.time() + interval
+            yield await self.get_act_values(machAxes, timeout)
+            await asyncio.sleep(max(t_next - loop.time(), 0.0))
+
+
+    async def subscribe_interference(self, objects, margin=0.0, timeout=None):
+        '''subscribe to the interference detection of the given objects (list of [docName, label]).
+        Boxes are grown by margin for an early warning. Changes of the overlapping pairs are
+        reported with the acknowledgements of the model updates, see self.interference'''
+        request = {'type': 'sub', 'topic': 'interference', 'objects': objects, 'margin': margin}
+        self._checkAnswer(await self._exchange(self._encodeRequest(request), timeout))
+
+        return self.interference
+
+
+    async def check_interference(self, timeout=None):
+        '''exact shape check of the overlapping pairs (rate-limited by the server):
+        returns a list of (object, object, common volume)'''
+        answer = await self._exchange(self._encodeRequest({'type': 'icc'}), timeout)
+        return self._checkAnswer(answer)['collisions']
+
+
+    async def evaluate_poses(self, machAxes, keys, poses, probes, progress=None, progress_every=100, timeout=None):
+        '''what-if query: let the server apply many machine axis poses and sample the global placement of probe objects.
+        machAxes: dict of the machine axes (docName, object, placementMode), keys: list of (machAx, component, sub)
+        (e.g. FCMCKinematics.mapping.keys), poses: array (poses, len(keys)), probes: list of [docName, label],
+        progress: callback(done, total), called every progress_every poses. The timeout applies to the whole batch.
+        With a heartbeat the server always reports the progress: choose progress_every so that the frames arrive
+        more often than the heartbeat timeout, otherwise a long batch looks like a dead server.
+        Returns an array (poses, probes, 7) of x, y, z and rotation quaternion x, y, z, w.
+        The server restores the original pose afterwards'''
+        request = {
+            'type': 'bpe',
+            'axes': machAxes,
+            'keys': [tuple(key) for key in keys],
+            'poses': np.asarray(poses, dtype=float),
+            'probes': probes,
+            'progress': progress_every if progress is not None or self.heartbeat_timeout is not None else 0,
+        }
+
+        answer = await self._exchange(self._encodeRequest(request), timeout, progress)
+        return self._checkAnswer(answer)['placements']
+
+
+    async def open_session(self, heartbeat=HEARTBEAT_TIMEOUT, timeout=None):
+        '''open a session on the server: after a reconnect, resume() restores the axis table, the resolved
+        CAD objects, limits and subscriptions in one round trip. With a heartbeat timeout (s) both sides
+        detect a dead peer: heartbeats are sent in the background, self.on_dead is called if no frame arrives
+        for longer than the heartbeat timeout'''
+        answer = await self._exchange(self._encodeRequest({'type': 'ses', 'heartbeat': heartbeat}), timeout)
+        self.token = self._checkAnswer(answer)['token']
+        self.heartbeat_timeout = heartbeat
+
+        if heartbeat is not None:
+            self._heartbeat = asyncio.ensure_future(self._sendHeartbeats())
+
+        return self.token
+
+
+    async def resume(self, timeout=None):
+        '''reconnect to the server and resume the session: returns the actual values of the
+        axes (machAxes dict) of the last get_act_values request of the session'''
+        if self.token is None:
+            raise RuntimeError("no session to resume, call open_session first")
+
+        await self.close()
+        await self.connect()
+
+        #setpoints sent before the break are no reference for velocities
+        if self.limits is not None:
+            self.limits.reset()
+
+        request = {'type': 'res', 'token': self.token, 'heartbeat': self.heartbeat_timeout}
+        answer = self._checkAnswer(await self._exchange(self._encodeRequest(request), timeout))
+
+        if self.heartbeat_timeout is not None:
+            self._heartbeat = asyncio.ensure_future(self._sendHeartbeats())
+
+        return answer['axes']
+
+
+    async def stop(self, machAxes=None, timeout=None):
+        '''priority stop: the update that was not sent yet is dropped, the server handles the request before the
+        updates queued ahead of it, discards the queued updates of the given axes (machAxes dict, default: all axes
+        of the last get_act_values request) and aborts a running batch evaluation. Returns a dict with the held
+        position 'axes' (actual values), the number of 'discarded' updates, the stop 'latency' measured by the
+        server and the round trip time 'rtt' in s'''
+        self._pending = None
+
+        t_start = time.perf_counter()
+        answer = self._checkAnswer(await self._exchange(self._encodeRequest({'type': 'stop', 'axes': machAxes}), timeout))
+        answer['rtt'] = time.perf_counter() - t_start
+
+        #the next setpoint does not continue the discarded ones
+        if self.limits is not None:
+            self.limits.reset()
+
+        return answer
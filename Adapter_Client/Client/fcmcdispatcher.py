@@ -0,0 +1,99 @@
+import asyncio
+import time
+from fcmcasyncclient import AsyncFCMCClient, TIMEOUT
+
+
+class FCMCDispatcher:
+    '''Drive several FCMC servers (e.g. one FreeCAD process per core) in parallel.
+    The machine axes are sharded by their docName: every server only holds the documents of its shard.
+
+    shards: dict of docName -> [address, port], e.g. the "shards" section of the configuration file
+
+    usage:
+        async with FCMCDispatcher(cad_config['shards']) as dispatcher:
+            machAxes = await dispatcher.get_act_values(machAxes)
+            latency = await dispatcher.send_values(machAxes)'''
+
+    def __init__(self, shards, timeout=TIMEOUT):
+        self.shards = {doc: (address, int(port)) for doc, (address, port) in shards.items()}
+        self.timeout = timeout
+
+        #one client per server, several documents may live in the same server
+        self.clients = {server: AsyncFCMCClient(server[0], server[1], timeout) for server in set(self.shards.values())}
+
+        #latency statistics per server: last, mean and max round trip time in s and number of updates
+        self.latency = {server: {'last': 0.0, 'mean': 0.0, 'max': 0.0, 'count': 0} for server in self.clients}
+
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+    def _split(self, machAxes):
+        '''split a machAxes dict into one dict per server'''
+        parts = {}
+
+        for machAx, axis_dict in machAxes.items():
+            try:
+                server = self.shards[axis_dict['docName']]
+            except KeyError:
+                raise ValueError("no shard configured for document '%s' of machine axis %s" % (axis_dict['docName'], machAx))
+
+            parts.setdefault(server, {})[machAx] = axis_dict
+
+        return parts
+
+
+    async def _update(self, server, part):
+        '''send one update to a server and wait for its acknowledgement, return the round trip time'''
+        client = self.clients[server]
+
+        t_start = time.perf_counter()
+        client.send_values(part)
+        await client.flush()
+        latency = time.perf_counter() - t_start
+
+        #update the statistics of the server
+        stats = self.latency[server]
+        stats['count'] += 1
+        stats['last'] = latency
+        stats['mean'] += (latency - stats['mean']) / stats['count']
+        stats['max'] = max(stats['max'], latency)
+
+        return latency
+
+
+    async def connect(self):
+        '''connect to all servers concurrently'''
+        await asyncio.gather(*(client.connect() for client in self.clients.values()))
+
+
+    async def close(self):
+        '''close all connections'''
+        await asyncio.gather(*(client.close() for client in self.clients.values()))
+
+
+    async def get_act_values(self, machAxes, timeout=None):
+        '''get the actual axis positions from all servers concurrently and merge them'''
+        parts = self._split(machAxes)
+        answers = await asyncio.gather(*(self.clients[server].get_act_values(part, timeout)
+                                         for server, part in parts.items()))
+
+        merged = {}
+        for answer in answers:
+            merged.update(answer)
+        return merged
+
+
+    async def send_values(self, targetVals):
+        '''send the target values of every shard to its server concurrently and gather the acknowledgements.
+        Returns the round trip time in s per server (address, port)'''
+        parts = self._split(targetVals)
+        latencies = await asyncio.gather(*(self._update(server, part) for server, part in parts.items()))
+
+        return dict(zip(parts, latencies))
@@ -0,0 +1,123 @@
+import numpy as np
+
+#kinds of limits that can be configured per machine axis (sub)component
+LIMIT_KINDS = ('min', 'max', 'vel', 'acc')
+
+
+class FCMCLimitError(ValueError):
+    '''setpoints violate the configured soft limits: violations holds one dict per violation
+    with the keys axis, component, sub, kind, value, limit and index (position in a trajectory)'''
+
+    def __init__(self, violations, text="setpoint violates soft limits"):
+        self.violations = violations
+        details = ", ".join("%s.%s.%s %s %.6g (limit %.6g)" % (v['axis'], v['component'], v['sub'], v['kind'], v['value'], v['limit'])
+                            for v in violations[:5])
+        super().__init__("%s: %s%s" % (text, details, " ..." if len(violations) > 5 else ""))
+
+
+class FCMCLimits:
+    '''Soft limits of the machine axes, precompiled into bound arrays for vectorized checks.
+
+    Limits are configured per machine axis in the machAxes section, e.g.:
+        "X1": {..., "limits": {"placement.x": {"min": "-400", "max": "0", "vel": "200", "acc": "2000"}}}
+    vel and acc are caps of the absolute velocity (units/s) and acceleration (units/s^2).
+    Violations are reported, values are never clamped.'''
+
+    def __init__(self, machAxes):
+        self.keys = []
+        bounds = []
+
+        for axis, axis_dict in machAxes.items():
+            if not isinstance(axis_dict, dict):
+                continue
+
+            for name, limit in axis_dict.get('limits', {}).items():
+                component, sub = name.split('.')
+                self.keys.append((axis, component, sub))
+                bounds.append([float(limit.get(kind, default)) for kind, default in
+                               zip(LIMIT_KINDS, (-np.inf, np.inf, np.inf, np.inf))])
+
+        bounds = np.array(bounds, dtype=float).reshape(-1, len(LIMIT_KINDS))
+        self.lower, self.upper, self.vel, self.acc = bounds.T.copy()
+
+        #last accepted setpoint(s) for checking a stream of single setpoints: (times, values)
+        self.history = None
+
+
+    def __bool__(self):
+        '''limits are only worth checking if at least one is configured'''
+        return len(self.keys) > 0
+
+
+    def _values(self, machAxes):
+        '''values of the limited (sub)components of a machAxes dict'''
+        return np.array([float(machAxes[axis][component][sub]) for axis, component, sub in self.keys])
+
+
+    def _violations(self, mask, kind, values, limits, offset):
+        '''build violation dicts from a (samples, keys) mask'''
+        violations = []
+        for index, column in zip(*np.nonzero(mask)):
+            axis, component, sub = self.keys[column]
+            violations.append({'axis': axis, 'component': component, 'sub': sub, 'kind': kind,
+                               'value': float(values[index, column]), 'limit': float(limits[column]),
+                               'index': int(index + offset)})
+        return violations
+
+
+    def checkTrajectory(self, values, times, keys=None):
+        '''check a whole trajectory in one vectorized pass and return the list of violations.
+        values has shape (samples, len(self.keys)) or, if keys is given, (samples, len(keys))
+        with columns in the order of keys (e.g. FCMCKinematics.mapping.keys); times has shape (samples,).
+        Without times only the position limits are checked'''
+        values = np.asarray(values, dtype=float)
+        times = np.zeros(1) if times is None else np.asarray(times, dtype=float)
+
+        if keys is not None:
+            #select the limited columns, (sub)components without a column cannot be checked
+            keys = list(keys)
+            columns = [keys.index(key) if key in keys else -1 for key in self.keys]
+            values = np.where(np.array(columns) >= 0, values[:, columns], np.nan)
+
+        with np.errstate(invalid='ignore'):
+            violations = self._violations(values < self.lower, 'min', values, self.lower, 0)
+            violations += self._violations(values > self.upper, 'max', values, self.upper, 0)
+
+            if len(times) > 1:
+                dt = np.diff(times)[:, None]
+                vel = np.diff(values, axis=0) / dt
+                violations += self._violations(np.abs(vel) > self.vel, 'vel', vel, self.vel, 1)
+
+                if len(times) > 2:
+                    acc = np.diff(vel, axis=0) / dt[1:]
+                    violations += self._violations(np.abs(acc) > self.acc, 'acc', acc, self.acc, 2)
+
+        return violations
+
+
+    def check(self, machAxes, t):
+        '''check a single setpoint (machAxes dict) at time t (s) against the limits and the
+        last accepted setpoints. The setpoint is only accepted if there are no violations.'''
+        values = self._values(machAxes)
+
+        if self.history is None:
+            times, trajectory = np.array([t]), values[None, :]
+        else:
+            times = np.append(self.history[0], t)
+            trajectory = np.vstack([self.history[1], values])
+
+        #only report violations of the new setpoint
+        violations = [v for v in self.checkTrajectory(trajectory, times) if v['index'] == len(times) - 1]
+        for v in violations:
+            v['index'] = 0
+
+        if not violations:
+            #remember the last two accepted setpoints for velocity and acceleration
+            self.history = (times[-2:], trajectory[-2:])
+
+        return violations
+
+
+    def reset(self):
+        '''forget the accepted setpoints, e.g. after the model was moved by someone else'''
+        self.history = None
@@ -1,21 +1,36 @@
-from tkinter import Y
 import FreeCAD as App
 import FreeCADGui
-from PySide import QtGui
+from PySide import QtGui, QtCore
+import os
 import select
 import socket
 import sys
 import pickle
 import math
-
-#tcp info
+import time
+import copy
+import secrets
+import numpy as np
+from fcmclimits import FCMCLimits
+from fcmcinterference import FCMCInterference, NARROW_INTERVAL
+
+#tcp info: the port can be overridden by the environment, e.g. to run one server per FreeCAD process
 TCP_ADDRESS = 'localhost'
-TCP_PORT = 1234
+TCP_PORT = int(os.environ.get('FCMC_PORT', 1234))
 HEADER_LENGTH = 10
 
+#run the server in the background, driven by FreeCAD's Qt event loop, instead of the blocking macro loop
+RUN_IN_BACKGROUND = False
+
 #rounding ceiling for actual values
 RND_PARAM = 3
 
+#time in s a session of a disconnected client is kept for resumption
+SESSION_TTL = 300.0
+
+#matrix elements exchanged in matrix mode (rotation and translation part of the 4x4 placement matrix)
+MATRIX_ELEMENTS = ('A11', 'A12', 'A13', 'A14', 'A21', 'A22', 'A23', 'A24', 'A31', 'A32', 'A33', 'A34')
+
 class FcmcServer:
     '''FreeCAD Motion Control Server: TCP server that connects a custom tcp client with a FreeCAD Document'''
 
@@ -27,10 +42,46 @@ class FcmcServer:
         self.listen_port = listen_port
         self.message_box = False
 
+        #soft limits configured in the machine axes, built from the client's scv request
+        self.limits = None
+
+        #resolved FreeCAD objects and prebuilt placement parts by machine axis
+        self.axis_cache = {}
+
+        #interference detection, active while a client is subscribed to it
+        self.interference = None
+
+        #connected client and, for the background server, the Qt socket notifiers
+        self.client_socket = None
+        self.listen_notifier = None
+        self.client_notifier = None
+
+        #sessions by token: state of disconnected clients, kept for fast resumption
+        self.sessions = {}
+        self.session_token = None
+        self.session_axes = None
+
+        #dead peer detection: the client is dropped if it is silent for longer than the heartbeat timeout
+        self.heartbeat_timeout = None
+        self.t_last_message = 0.0
+        self.watchdog = None
+
+        #correlation id and channel of the request being handled, returned with every frame answering it
+        self.tag = {}
+
+        #frames received but not handled yet as (time of arrival, message), a stop request is handled first.
+        #The client may close the connection while frames are still queued
+        self.queue = []
+        self.peer_closed = False
+        self.t_arrival = 0.0
+
     def _terminate(self):
         '''terminate the server'''
         self.is_running = False
 
+        #the background server has no loop that could notice
+        self.stop()
+
     def _showDialog(self):
         '''present a message box to show status of server. Close-button is used to terminate the server'''
         mb = QtGui.QMessageBox()
@@ -56,20 +107,36 @@ class FcmcServer:
         full_msg = msg_header + myMsg
 
         #send the message
-        self.client_socket.send(full_msg)
+        self.client_socket.sendall(full_msg)
+
+
+    def _recvExactly(self, length):
+        '''receive exactly length bytes, large messages may arrive in several parts'''
+        data = b""
+        while len(data) < length:
+            part = self.client_socket.recv(length - len(data))
+            if not part:
+                raise ConnectionError("connection closed by the client")
+            data += part
+        return data
 
 
     def _recvMessage(self):
-        '''method to receive messages'''
+        '''method to receive messages, returns None if the client closed the connection'''
         try:
             #receive the fixed length header
             message_header = self.client_socket.recv(HEADER_LENGTH)
 
+            if not message_header:
+                #the client closed the connection
+                return None
+
             #figure out how long the message body will be
+            message_header += self._recvExactly(HEADER_LENGTH - len(message_header))
             message_length = int(message_header.decode("utf-8").strip())
 
             #return the message   
-            return pickle.loads(self.client_socket.recv(message_length))   
+            return pickle.loads(self._recvExactly(message_length))   
 
         except:
             #something went wrong while receiving
@@ -88,170 +155,674 @@ class FcmcServer:
             #the type property is no longer required, delete it so it won't get sent back to the client
             del answ_dict['type']
 
-            #iterate through all configured objects
-            for machAx in answ_dict:
-                #append actual values to the recv'd dict
-                try:
-                    answ_dict[machAx] = self._getActValues(answ_dict[machAx])
-                except:
-                    pass
+            #(re)build the soft limits: the client may have moved the model in the meantime
+            self.limits = FCMCLimits(answ_dict)
+
+            #remember the axis table for a resumption of the session
+            self.session_axes = copy.deepcopy(answ_dict)
 
             #return updated dict
-            return answ_dict
+            return self._answerSCV(answ_dict)
+
+        elif req_type == 'hb':
+        #handle heartbeat: answer right away
+            return {'type': 'hb'}
+
+        elif req_type == 'ses':
+        #handle session request: open a session that can be resumed after a reconnect
+            self._openSession()
+            self.heartbeat_timeout = request.get('heartbeat')
+
+            return {'type': 'ses', 'token': self.session_token}
+
+        elif req_type == 'res':
+        #handle resume request: restore the state of a previous connection
+            if not self._resumeSession(request['token']):
+                return {'type': 'err', 'error': 'unknown session'}
+
+            self.heartbeat_timeout = request.get('heartbeat', self.heartbeat_timeout)
+
+            #answer with the actual values of the negotiated axis table
+            return {'type': 'res', 'token': self.session_token, 'axes': self._answerSCV(copy.deepcopy(self.session_axes))}
 
         elif req_type == 'umr':
         #handle umr request
             del request['type']
+
+            #time of the setpoint: stamped by the client, otherwise the time of arrival
+            t = request.pop('t', time.monotonic())
+
+            #never apply setpoints outside of the soft limits: report the violations to the client
+            violations = self._checkLimits(request, t)
+            if violations:
+                return {'type': 'err', 'error': 'limits', 'violations': violations}
+
             self._updateCAD(request)
 
+            #report changes of the overlapping pairs to the subscribed client with the acknowledgement
+            if self.interference is not None:
+                previous = self.interference.pairs
+                if self.interference.broadPhase() != previous:
+                    request['interference'] = self.interference.pairs
+
+        elif req_type == 'bpe':
+        #handle batch pose evaluation request
+            return self._evaluatePoses(request)
+
+        elif req_type == 'stop':
+        #handle stop request: discard the queued updates and report the held position
+            return self._stop(request)
+
+        elif req_type == 'sub':
+        #handle subscription request
+            if request['topic'] != 'interference':
+                return {'type': 'err', 'error': 'unknown topic: %s' % request['topic']}
+
+            #cache the local bounding boxes of the objects to watch
+            self.interference = FCMCInterference(request['objects'], request.get('margin', 0.0))
+
+            return {'type': 'sub', 'topic': 'interference', 'interference': self.interference.broadPhase()}
+
+        elif req_type == 'icc':
+        #handle interference check request (exact shape check of the overlapping pairs)
+            if self.interference is None:
+                return {'type': 'err', 'error': 'not subscribed to interference'}
+
+            collisions = self.interference.narrowPhase()
+            if collisions is None:
+                return {'type': 'err', 'error': 'rate limited', 'retry': NARROW_INTERVAL}
+
+            return {'type': 'icc', 'collisions': collisions}
+
+
+    def _answerSCV(self, answ_dict):
+        '''fill in the actual values of all axes of an scv request'''
+        #iterate through all configured objects
+        for machAx in answ_dict:
+            #append actual values to the recv'd dict
+            try:
+                answ_dict[machAx] = self._getActValues(answ_dict[machAx], machAx)
+            except:
+                pass
+
+        return answ_dict
+
+
+    def _openSession(self):
+        '''open a new session for the connected client, expired sessions are discarded'''
+        now = time.monotonic()
+        self.sessions = {token: session for token, session in self.sessions.items() if now - session['t'] < SESSION_TTL}
+
+        self.session_token = secrets.token_hex(16)
+        self._saveSession()
+
+
+    def _saveSession(self):
+        '''store the state of the connected client in its session'''
+        if self.session_token is None:
+            return
+
+        self.sessions[self.session_token] = {
+            't': time.monotonic(),
+            'axes': self.session_axes,
+            'axis_cache': self.axis_cache,
+            'limits': self.limits,
+            'interference': self.interference,
+            'heartbeat': self.heartbeat_timeout,
+        }
+
+
+    def _resumeSession(self, token):
+        '''restore the state of a session: axis table, resolved objects, limits and subscriptions'''
+        session = self.sessions.get(token)
+        if session is None or session['axes'] is None:
+            return False
+
+        self.session_token = token
+        self.session_axes = session['axes']
+        self.axis_cache = session['axis_cache']
+        self.limits = session['limits']
+        self.interference = session['interference']
+        self.heartbeat_timeout = session['heartbeat']
+
+        #the setpoint history of the limits is meaningless after a break
+        if self.limits is not None:
+            self.limits.reset()
+
+        return True
+
+
+    def _stop(self, request):
+        '''discard the queued updates of the axes to stop and answer with their actual (held) position.
+        request: 'axes' machAxes dict of the axes to stop, None to stop all axes of the session'''
+        axes = request.get('axes')
+        discarded = []
+
+        for frame in [frame for frame in self.queue if frame[1].get('type') == 'umr']:
+            update = frame[1]
+            if axes is not None:
+                #only the setpoints of the stopped axes are discarded
+                for machAx in axes:
+                    update.pop(machAx, None)
+                if any(key not in ('type', 't', 'id', 'ch') for key in update):
+                    continue
+
+            self.queue.remove(frame)
+            discarded.append({key: update[key] for key in ('id', 'ch') if key in update})
+
+        #the discarded updates are acknowledged, so the client does not wait for them
+        for tag in discarded:
+            self._sendMessage({'type': 'umr', 'discarded': True, **tag})
+
+        #actual values of the stopped axes
+        held = copy.deepcopy(axes if axes is not None else self.session_axes or {})
+
+        return {'type': 'stop', 'axes': self._answerSCV(held), 'discarded': len(discarded),
+                'latency': time.monotonic() - self.t_arrival}
+
+
+    def _stopRequested(self):
+        '''check for a stop request without waiting, e.g. during a long batch'''
+        self._readFrames()
+        return any(message.get('type') == 'stop' for _, message in self.queue)
+
+
+    def _checkLimits(self, upd_dict, t):
+        '''check an update against the soft limits configured in the machine axes'''
+        if self.limits is None:
+            self.limits = FCMCLimits(upd_dict)
+
+        if not self.limits:
+            return []
+
+        return self.limits.check(upd_dict, t)
+
         
         
-    def _getActValues(self, axis_dict):
-        '''get actual values from FreeCAD Document for a given machine axis''' 
-        #extract relevant info for querying actual values from FreeCAD
+    def _getAxisCache(self, machAx, axis_dict):
+        '''get the resolved FreeCAD object and the prebuilt placement parts of a machine axis'''
         doc = axis_dict['docName']
         obj = axis_dict['object']
 
-        #actual placement
-        axis_dict['placement']['x'] = round(App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset.Base.x, RND_PARAM)
-        axis_dict['placement']['y'] = round(App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset.Base.y, RND_PARAM)
-        axis_dict['placement']['z'] = round(App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset.Base.z, RND_PARAM)
+        cache = self.axis_cache.get(machAx)
+
+        if cache is None or cache['docName'] != doc or cache['label'] != obj:
+            #resolve the object only once instead of searching it by label on every update
+            cache = {
+                'docName': doc,
+                'label': obj,
+                'document': App.getDocument(doc),
+                'object': App.getDocument(doc).getObjectsByLabel(obj)[0],
+                'vector': App.Vector(),
+                'rotation': App.Rotation(),
+                'matrix': App.Matrix(),
+                'placement': App.Placement(),
+            }
+            self.axis_cache[machAx] = cache
+
+        return cache
 
-        #actual rotation
-        rad_angle = App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset.Rotation.Angle
-        axis_dict['rotation']['angle'] = round(rad_angle * 180 / math.pi, RND_PARAM)
-        axis_dict['rotation']['x'] = round(App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset.Rotation.Axis.x, RND_PARAM)
-        axis_dict['rotation']['y'] = round(App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset.Rotation.Axis.y, RND_PARAM)
-        axis_dict['rotation']['z'] = round(App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset.Rotation.Axis.z, RND_PARAM)
+
+    def _getActValues(self, axis_dict, machAx):
+        '''get actual values from FreeCAD Document for a given machine axis''' 
+        #extract relevant info for querying actual values from FreeCAD
+        offset = self._getAxisCache(machAx, axis_dict)['object'].AttachmentOffset
+        mode = axis_dict.get('placementMode', 'axisangle')
+
+        if mode == 'quaternion':
+            #full precision: placement and rotation quaternion (x, y, z, w) without conversions
+            axis_dict['placement'] = {'x': offset.Base.x, 'y': offset.Base.y, 'z': offset.Base.z}
+            axis_dict['quaternion'] = dict(zip('xyzw', offset.Rotation.Q))
+
+        elif mode == 'matrix':
+            #full precision: rotation and translation part of the placement matrix
+            matrix = offset.toMatrix()
+            axis_dict['matrix'] = {element: getattr(matrix, element) for element in MATRIX_ELEMENTS}
+
+        else:
+            #actual placement
+            axis_dict['placement']['x'] = round(offset.Base.x, RND_PARAM)
+            axis_dict['placement']['y'] = round(offset.Base.y, RND_PARAM)
+            axis_dict['placement']['z'] = round(offset.Base.z, RND_PARAM)
+
+            #actual rotation
+            rad_angle = offset.Rotation.Angle
+            axis_dict['rotation']['angle'] = round(rad_angle * 180 / math.pi, RND_PARAM)
+            axis_dict['rotation']['x'] = round(offset.Rotation.Axis.x, RND_PARAM)
+            axis_dict['rotation']['y'] = round(offset.Rotation.Axis.y, RND_PARAM)
+            axis_dict['rotation']['z'] = round(offset.Rotation.Axis.z, RND_PARAM)
 
         return axis_dict     
 
 
+    def _applyAxis(self, machAx, axis_dict):
+        '''set the placement of a machine axis in the FreeCAD document (without recompute)'''
+        cache = self._getAxisCache(machAx, axis_dict)
+        mode = axis_dict.get('placementMode', 'axisangle')
+
+        if mode == 'quaternion':
+            #reuse the prebuilt vector and rotation: no axis/angle or degree conversions
+            vector = cache['vector']
+            vector.x = float(axis_dict['placement']['x'])
+            vector.y = float(axis_dict['placement']['y'])
+            vector.z = float(axis_dict['placement']['z'])
+
+            quat = axis_dict['quaternion']
+            cache['rotation'].Q = (float(quat['x']), float(quat['y']), float(quat['z']), float(quat['w']))
+
+            placement = cache['placement']
+            placement.Base = vector
+            placement.Rotation = cache['rotation']
+
+        elif mode == 'matrix':
+            #reuse the prebuilt matrix, the last row stays (0, 0, 0, 1)
+            matrix = cache['matrix']
+            for element in MATRIX_ELEMENTS:
+                setattr(matrix, element, float(axis_dict['matrix'][element]))
+
+            placement = cache['placement']
+            placement.Matrix = matrix
+
+        else:
+            #placement vector components
+            x = axis_dict['placement']['x']
+            y = axis_dict['placement']['y']
+            z = axis_dict['placement']['z']
+
+            #rotation vector components
+            rot_x = axis_dict['rotation']['x']
+            rot_y = axis_dict['rotation']['y']
+            rot_z = axis_dict['rotation']['z']
+            angle = axis_dict['rotation']['angle']
+
+            placement = App.Placement(App.Vector(x,y,z),App.Rotation(App.Vector(rot_x, rot_y, rot_z), angle))
+
+        #update the axis values in the freecad document
+        cache['object'].AttachmentOffset = placement
+
+
     def _updateCAD(self, upd_dict):
         '''method to interact with FreeCAD model'''
         #iterate through all axes that need to be updated
         for machAx in upd_dict:
-            #extract relevant info fo rupdating the values
-            doc = upd_dict[machAx]['docName']
-            obj = upd_dict[machAx]['object']
+            self._applyAxis(machAx, upd_dict[machAx])
+
+        #recompute the documents of the updated axes: the active document may be another one
+        #(background server) or not hold the axes at all (several documents per server)
+        self._recomputeDocuments(self.axis_cache[machAx]['document'] for machAx in upd_dict)
+
+
+    def _recomputeDocuments(self, docs):
+        '''recompute the given documents and every open document that links to them (e.g. an Assembly4
+        assembly moving parts from their own documents), dependent documents after their dependencies'''
+        docs = list(dict.fromkeys(docs))
+        names = {doc.Name for doc in docs}
+
+        #getDependentDocuments() lists the documents a document links to, including itself
+        dependents = {}
+        for doc in App.listDocuments().values():
+            if doc.Name not in names:
+                linked = {dep.Name for dep in doc.getDependentDocuments()}
+                if linked & names:
+                    dependents[doc] = len(linked)
+
+        #a document that links to another dependent document links to more documents than that one
+        for doc in docs + sorted(dependents, key=dependents.get):
+            doc.recompute()
+
+
+    def _evaluatePoses(self, request):
+        '''apply many machine axis poses one after the other and sample the global placement of probe objects.
+        request: 'axes' machAxes dict (docName, object, placementMode of the axes),
+                 'keys' list of (machAx, component, sub), 'poses' array (poses, len(keys)),
+                 'probes' list of [docName, label], 'progress' number of poses between progress messages (0: none).
+        Returns an array (poses, probes, 7): position x, y, z and rotation quaternion x, y, z, w of every probe.
+        The original pose is restored afterwards.'''
+        keys = [tuple(key) for key in request['keys']]
+        poses = np.asarray(request['poses'], dtype=float).reshape(-1, len(keys))
+        every = int(request.get('progress', 0))
+
+        #reject the batch if any pose violates the soft limits (positions only, the poses are no trajectory)
+        if self.limits:
+            violations = self.limits.checkTrajectory(poses, None, keys)
+            if violations:
+                return {'type': 'err', 'error': 'limits', 'violations': violations}
+
+        #only the axes that are part of the poses are applied
+        axes = {machAx: request['axes'][machAx] for machAx in dict.fromkeys(key[0] for key in keys)}
+        probes = [App.getDocument(doc).getObjectsByLabel(label)[0] for doc, label in request['probes']]
+
+        #only the documents of the axes and of the probes (and the documents linking to them) are recomputed
+        docs = [App.getDocument(doc) for doc in dict.fromkeys(
+            [axis_dict['docName'] for axis_dict in axes.values()] + [doc for doc, _ in request['probes']])]
+
+        #remember the original pose
+        originals = {machAx: self._getAxisCache(machAx, axis_dict)['object'].AttachmentOffset.copy()
+                     for machAx, axis_dict in axes.items()}
+
+        result = np.empty((len(poses), len(probes), 7))
 
-            #placement vector components
-            x = upd_dict[machAx]['placement']['x']
-            y = upd_dict[machAx]['placement']['y']
-            z = upd_dict[machAx]['placement']['z']
+        try:
+            for i, pose in enumerate(poses):
+                #a stop request aborts the batch
+                if self._stopRequested():
+                    return {'type': 'err', 'error': 'stopped'}
 
-            #rotation vector components
-            rot_x = upd_dict[machAx]['rotation']['x']
-            rot_y = upd_dict[machAx]['rotation']['y']
-            rot_z = upd_dict[machAx]['rotation']['z']
-            angle = upd_dict[machAx]['rotation']['angle']
+                for (machAx, component, sub), value in zip(keys, pose):
+                    axes[machAx][component][sub] = value
 
-            #update the axis values in the freecad document
-            App.getDocument(doc).getObjectsByLabel(obj)[0].AttachmentOffset = App.Placement(App.Vector(x,y,z),App.Rotation(App.Vector(rot_x, rot_y, rot_z), angle))
+                for machAx, axis_dict in axes.items():
+                    self._applyAxis(machAx, axis_dict)
 
-        #recompute the CAD model
-        App.ActiveDocument.recompute()
+                self._recomputeDocuments(docs)
 
+                #sample the global placement of all probes
+                for j, probe in enumerate(probes):
+                    placement = probe.getGlobalPlacement()
+                    result[i, j, :3] = (placement.Base.x, placement.Base.y, placement.Base.z)
+                    result[i, j, 3:] = placement.Rotation.Q
 
-    def run(self, with_dialog=True):
-        '''method to run the server'''
-        self.is_running=True
+                #report the progress of long batches
+                if every and (i + 1) % every == 0 and i + 1 < len(poses):
+                    self._sendMessage({'type': 'prg', 'done': i + 1, 'total': len(poses), **self.tag})
+
+        finally:
+            #restore the original pose
+            for machAx, placement in originals.items():
+                self.axis_cache[machAx]['object'].AttachmentOffset = placement
+
+            self._recomputeDocuments(docs)
+
+        return {'type': 'bpe', 'placements': result}
 
-        #tcp setup
+
+    def _listen(self):
+        '''open the listening socket'''
         self.input_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.input_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.input_socket.bind((self.listen_address, self.listen_port))
+        self.input_socket.listen(1)
+
+
+    def _acceptClient(self):
+        '''accept a client connection, a previous client is dropped'''
+        if self.client_socket is not None:
+            self._dropClient()
+
+        self.client_socket, address = self.input_socket.accept()
+        self.remote_address = address[0]
+
+        #objects may have been deleted or renamed since the last connection
+        #(a resumed session brings back its state)
+        self.axis_cache = {}
+        self.interference = None
+        self.limits = None
+        self.session_token = None
+        self.session_axes = None
+        self.heartbeat_timeout = None
+        self.t_last_message = time.monotonic()
+        self.queue = []
+        self.peer_closed = False
+
+        #answers should not wait for more data to be sent: heartbeats are small
+        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        #update message box to show the connection state
+        if self.message_box:
+            self.message_box.setText("Connection established!")
+
+
+    def _dropClient(self):
+        '''close the connection to the current client, its session is kept for a resumption'''
+        self._saveSession()
+
+        if self.watchdog is not None:
+            self.watchdog.stop()
+
+        if self.client_notifier is not None:
+            self.client_notifier.setEnabled(False)
+            self.client_notifier = None
+
+        self.client_socket.close()
+        self.client_socket = None
+
+        if self.message_box:
+            self.message_box.setText("Wait for connection...")
+
+
+    def _readFrames(self):
+        '''receive all frames that arrived, without waiting for more'''
+        while not self.peer_closed and select.select([self.client_socket], [], [], 0)[0]:
+            message = self._recvMessage()
 
+            if message is None:
+                #the client closed the connection
+                self.peer_closed = True
+            elif message == "blocked!":
+                #the socket is blocked, keep receiving later
+                break
+            else:
+                #the client is alive
+                self.t_last_message = time.monotonic()
+
+                if isinstance(message, dict):
+                    self.queue.append((self.t_last_message, message))
+                else:
+                    print("FCMC Server: ignored message of unknown format")
+
+
+    def _serveClient(self):
+        '''receive the frames of the client, handle and answer them. A stop request is handled before
+        the frames queued ahead of it. Only the frames queued when the pass starts are handled, so a client
+        streaming continuously cannot starve FreeCAD's GUI: later frames are left for the next pass.
+        Returns False if the client closed the connection and all its frames are handled'''
+        self._readFrames()
+
+        for _ in range(len(self.queue)):
+            if not self.queue:
+                #a stop request discarded the rest of the pass
+                break
+
+            #priority lane: a stop request overtakes the queued updates, even if it arrived during the pass
+            self._readFrames()
+            frame = next((frame for frame in self.queue if frame[1].get('type') == 'stop'), self.queue[0])
+            self.queue.remove(frame)
+            self.t_arrival, message = frame
+
+            self._serveFrame(message)
+
+        return not self.peer_closed or bool(self.queue)
+
+
+    def _serveFrame(self, message):
+        '''handle one message of the client and answer it'''
         try:
-            self.input_socket.bind((self.listen_address, self.listen_port))
-            self.input_socket.listen(1)
+            #requests tagged with an id (and a channel) may be answered out of order by the client:
+            #the tag is taken off the request and put on the answer
+            self.tag = {key: message.pop(key) for key in ('id', 'ch') if key in message}
+
+            #a message was received: handle the request
+            try:
+                answer = self._handleRequest(message)
+            except Exception as e:
+                #report the error, the client would otherwise wait for an answer in vain
+                print("Error handling message: %s" % e)
+                answer = {'type': 'err', 'error': str(e)}
+
+            #the model was updated: acknowledge readiness to receive 
+            #by returning the message sent by the client (or the answer to the request).
+            answer = message if answer is None else answer
+            answer.update(self.tag)
+
+            try:
+                self._sendMessage(answer)
+            except:
+                print("error sending acknowledgement")
+
+            #the client could not send heartbeats while a long request was handled
+            self.t_last_message = time.monotonic()
+
+        except:
+            print("Error handling message: %s" % sys.exc_info()[1])
+
+
+    def _peerIsDead(self):
+        '''check whether the client has been silent for longer than its heartbeat timeout'''
+        return (self.client_socket is not None and self.heartbeat_timeout is not None and
+                time.monotonic() - self.t_last_message > self.heartbeat_timeout)
+
+
+    def _shutdown(self):
+        '''close all sockets'''
+        if self.client_socket is not None:
+            self._dropClient()
 
-            read_list = [self.input_socket]
+        print("FCMC Server is terminating. Bye for now!")
+        self.input_socket.close()
+
+
+    def run(self, with_dialog=True):
+        '''method to run the server in a blocking loop'''
+        self.is_running=True
+
+        try:
+            #tcp setup
+            self._listen()
 
             if with_dialog:
                 self._showDialog()
-            
-            write_list = []
 
             #main server loop
             while self.is_running:                
                 #keep FreeCAD from freezing up:
                 FreeCADGui.updateGui()
 
-                #select statement
-                readable, writable, errored = select.select(read_list, write_list, [], 0.05)
+                read_list = [self.input_socket]
+                if self.client_socket is not None:
+                    read_list.append(self.client_socket)
+
+                #select statement: wake up early enough to notice a missing heartbeat
+                wait = 0.05 if self.heartbeat_timeout is None else min(0.05, self.heartbeat_timeout / 4)
+                readable, writable, errored = select.select(read_list, [], [], wait)
                 
                 for s in readable:
-                    
                     if s is self.input_socket:
-                        #first communication between server and client
-                        self.client_socket, address = self.input_socket.accept()
-
-                        read_list.append(self.client_socket)
-
-                        self.remote_address = address[0]
-
-                        #update message box to show the connection state
-                        if self.message_box:
-                            self.message_box.setText("Connection established!")
-
-                        #receive scv (Send Current Values) request
-                        try:
-                            message = self._recvMessage()
-
-                            if not message == "blocked!":
-                                answer = self._handleRequest(message)
-
-                        except:
-                            print("Error receiving setup message")
-                            continue
-                        
-                        #send CAD configuration to the client
-                        self._sendMessage(answer)
-
-                    else:
-                        #all subsequent communication between server and client
-                        
-                        try:
-                            #receive a message
-                            message = self._recvMessage()
-                            
-                            if message is False:
-                                #the client didn't send anything, so keep receiving
-                                continue
-                            elif message == "blocked":
-                                #the socket is blocked, keep receiving
-                                continue
-
-                            #a message was received: handle the request
-                            self._handleRequest(message)
-
-                            #the model was updated: acknowledge readiness to receive 
-                            #by returning the message sent by the client.
-                            try:
-                                self._sendMessage(message)
-                            except:
-                                print("error sending acknowledgement")
-
-                        except:
-                            #the socket is blocked, keep receiving
-                            continue
-
-        except ValueError:
-            print("Value Error of FCMC Server: %s\r\n" % sys.exc_info()[1])
+                        #a client connects
+                        self._acceptClient()
 
-            try:
-                self.input_socket.shutdown(socket.SHUT_RDWR)
-            except OSError:
-                print("OSError of FCMC Server while trying to close the socket")
+                    elif not self._serveClient():
+                        #the client disconnected
+                        self._dropClient()
 
-        print("FCMC Server is terminating. Bye for now!")
-        self.input_socket.close()
+                #frames left over from the last pass are handled without waiting for more data
+                if self.client_socket is not None and self.queue and self.client_socket not in readable:
+                    if not self._serveClient():
+                        self._dropClient()
+
+                if self._peerIsDead():
+                    print("FCMC Server: no heartbeat from the client, connection dropped")
+                    self._dropClient()
+
+        except (ValueError, OSError):
+            print("Error of FCMC Server: %s\r\n" % sys.exc_info()[1])
+
+        self._shutdown()
+
+
+    def start(self, with_dialog=True):
+        '''method to run the server in the background: the sockets are watched by FreeCAD's own Qt event loop,
+        so messages are handled as soon as they arrive, there is no polling while idle
+        and FreeCAD can be used as usual while the server is running. Stop it with stop()'''
+        self.is_running = True
+        self._listen()
+
+        #the accepted client sockets must not block the event loop
+        self.input_socket.setblocking(False)
+
+        self.listen_notifier = QtCore.QSocketNotifier(self.input_socket.fileno(), QtCore.QSocketNotifier.Read)
+        self.listen_notifier.activated.connect(self._onConnect)
+
+        if with_dialog:
+            self._showDialog()
+
+
+    def _onConnect(self, *args):
+        '''slot: a client connects to the background server'''
+        try:
+            self._acceptClient()
+        except BlockingIOError:
+            return
+
+        #messages are read with blocking calls as soon as (part of) them arrived
+        self.client_socket.setblocking(True)
+
+        self.client_notifier = QtCore.QSocketNotifier(self.client_socket.fileno(), QtCore.QSocketNotifier.Read)
+        self.client_notifier.activated.connect(self._onMessage)
+
+        #single shot timer for dead peer detection, (re)started by every message
+        if self.watchdog is None:
+            self.watchdog = QtCore.QTimer()
+            self.watchdog.setSingleShot(True)
+            self.watchdog.setTimerType(QtCore.Qt.PreciseTimer)
+            self.watchdog.timeout.connect(self._onHeartbeatTimeout)
+
+
+    def _onMessage(self, *args):
+        '''slot: a message of the client arrived at the background server'''
+        if self.client_socket is None:
+            #the client was dropped before a deferred pass
+            return
+
+        if not self._serveClient():
+            self._dropClient()
+            return
+
+        if self.heartbeat_timeout is not None:
+            self._armWatchdog()
+
+        if self.queue:
+            #frames left over from this pass: handle them once the pending GUI events are processed
+            QtCore.QTimer.singleShot(0, self._onMessage)
+
+
+    def _armWatchdog(self):
+        '''start the watchdog to fire when the heartbeat timeout of the client runs out'''
+        remaining = self.heartbeat_timeout - (time.monotonic() - self.t_last_message)
+        self.watchdog.start(max(1, math.ceil(remaining * 1000)))
+
+
+    def _onHeartbeatTimeout(self):
+        '''slot: the client of the background server missed its heartbeat'''
+        if self._peerIsDead():
+            print("FCMC Server: no heartbeat from the client, connection dropped")
+            self._dropClient()
+        elif self.client_socket is not None and self.heartbeat_timeout is not None:
+            #the timer fired early: wait for the rest of the timeout
+            self._armWatchdog()
+
+
+    def stop(self):
+        '''stop the background server'''
+        self.is_running = False
+
+        if self.listen_notifier is not None:
+            self.listen_notifier.setEnabled(False)
+            self.listen_notifier = None
+            self._shutdown()
 
 
 def main():
     '''main function of the server application'''
+    global background_server
+
     server = FcmcServer(TCP_ADDRESS, TCP_PORT)
-    server.run()
+
+    if RUN_IN_BACKGROUND:
+        #keep a reference, the server lives on after the macro has finished
+        background_server = server
+        server.start()
+    else:
+        server.run()
 
 
 if __name__ == '__main__':
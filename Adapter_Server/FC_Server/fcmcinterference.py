@@ -0,0 +1,133 @@
+import time
+import numpy as np
+import FreeCAD as App
+import Part
+
+#minimum time between two narrow-phase (exact shape) checks in s
+NARROW_INTERVAL = 1.0
+
+#corners of the unit box, combined with the bounding box limits to get the 8 box corners
+_CORNERS = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=float)
+
+
+class FCMCInterference:
+    '''Broad-phase interference detection of moving objects:
+    the local bounding box of every object is cached once and transformed by the object's
+    current global placement after each update, overlapping boxes are found by sweep and prune.
+    The exact (narrow-phase) shape check only runs on demand and is rate-limited.
+
+    Parts that are placed through App::Link objects (e.g. Assembly4: the parts live in their own documents
+    and are moved by links in the assembly document) have to be given as the link objects: the shape is
+    resolved through the link and the global placement of the link includes the link placement.
+
+    objects: list of [docName, label] of the objects to check (shapes or links to shapes)
+    margin:  boxes are grown by this distance, to warn before parts actually touch'''
+
+    def __init__(self, objects, margin=0.0):
+        self.margin = float(margin)
+        self.names = []
+        self.objects = []
+        local_boxes = []
+
+        for doc, label in objects:
+            obj = App.getDocument(doc).getObjectsByLabel(label)[0]
+            self._checkPlacedHere(obj, doc, label)
+
+            #bounding box of the shape in the object's own coordinate system
+            shape = self._localShape(obj)
+            if shape.isNull():
+                raise ValueError("interference object %s/%s has no shape" % (doc, label))
+            box = shape.BoundBox
+
+            self.names.append("%s/%s" % (doc, label))
+            self.objects.append(obj)
+            local_boxes.append([[box.XMin, box.YMin, box.ZMin], [box.XMax, box.YMax, box.ZMax]])
+
+        #corners of all local boxes, shape (objects, 8, 3)
+        local_boxes = np.array(local_boxes, dtype=float).reshape(-1, 2, 3)
+        self.corners = local_boxes[:, 0, None, :] + _CORNERS * (local_boxes[:, 1] - local_boxes[:, 0])[:, None, :]
+
+        #overlapping pairs found by the last broad phase
+        self.pairs = []
+        self.t_narrow = None
+
+
+    def _checkPlacedHere(self, obj, doc, label):
+        '''an object moved by a link in another document cannot be followed from its own document'''
+        for parent in obj.InListRecursive:
+            if parent.Document.Name != obj.Document.Name:
+                raise ValueError("interference object %s/%s is placed by %s/%s: use the link object instead"
+                                 % (doc, label, parent.Document.Name, parent.Label))
+
+
+    def _localShape(self, obj):
+        '''shape of an object or of the object a link points to, in the object's own coordinate system'''
+        shape = Part.getShape(obj)
+        shape.Placement = App.Placement()
+        return shape
+
+
+    def _globalBoxes(self):
+        '''axis aligned boxes of all objects at their current global placement, shape (objects, 2, 3)'''
+        rotations = np.empty((len(self.objects), 3, 3))
+        translations = np.empty((len(self.objects), 3))
+
+        for i, obj in enumerate(self.objects):
+            matrix = obj.getGlobalPlacement().toMatrix()
+            rotations[i] = [[matrix.A11, matrix.A12, matrix.A13],
+                            [matrix.A21, matrix.A22, matrix.A23],
+                            [matrix.A31, matrix.A32, matrix.A33]]
+            translations[i] = [matrix.A14, matrix.A24, matrix.A34]
+
+        #transform the cached corners of all objects at once
+        corners = np.einsum('nij,nkj->nki', rotations, self.corners) + translations[:, None, :]
+
+        return np.stack([corners.min(axis=1) - self.margin, corners.max(axis=1) + self.margin], axis=1)
+
+
+    def broadPhase(self):
+        '''find all pairs of objects whose boxes overlap (sweep and prune along x)'''
+        boxes = self._globalBoxes()
+        order = np.argsort(boxes[:, 0, 0])
+        pairs = []
+        active = []
+
+        for i in order:
+            #boxes that end before this one starts can no longer overlap anything
+            active = [j for j in active if boxes[j, 1, 0] >= boxes[i, 0, 0]]
+
+            for j in active:
+                if np.all(boxes[i, 0, 1:] <= boxes[j, 1, 1:]) and np.all(boxes[j, 0, 1:] <= boxes[i, 1, 1:]):
+                    pairs.append(tuple(sorted((self.names[i], self.names[j]))))
+
+            active.append(i)
+
+        self.pairs = sorted(pairs)
+        return self.pairs
+
+
+    def narrowPhase(self):
+        '''exact shape check of the pairs found by the last broad phase: returns the pairs that
+        actually intersect with their common volume. Returns None if called within NARROW_INTERVAL of the last check'''
+        now = time.monotonic()
+        if self.t_narrow is not None and now - self.t_narrow < NARROW_INTERVAL:
+            return None
+        self.t_narrow = now
+
+        shapes = {}
+        collisions = []
+
+        for pair in self.pairs:
+            for name in pair:
+                if name not in shapes:
+                    #shape at the object's global placement
+                    obj = self.objects[self.names.index(name)]
+                    shape = self._localShape(obj)
+                    shape.Placement = obj.getGlobalPlacement()
+                    shapes[name] = shape
+
+            volume = shapes[pair[0]].common(shapes[pair[1]]).Volume
+            if volume > 0.0:
+                collisions.append((pair[0], pair[1], volume))
+
+        return collisions
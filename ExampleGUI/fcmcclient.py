@@ -1,28 +1,84 @@
+import select
 import socket
 import sys
 import pickle
+import time
+import numpy as np
+from fcmclimits import FCMCLimits, FCMCLimitError
 
 #tcp info
 TCP_ADDRESS = 'localhost'
 TCP_PORT = 1234
 HEADER_LENGTH = 10
 
+#default time in s after which a silent peer is considered dead
+HEARTBEAT_TIMEOUT = 0.5
+
+#default time in s to wait for the answer to a request (or its next progress message),
+#a recompute of a large model can take a while
+REQUEST_TIMEOUT = 5.0
+
+#channel of every request type: frames are tagged with a correlation id and their channel,
+#so requests of different channels can be in flight at the same time
+CHANNELS = {'umr': 'motion', 'scv': 'query', 'bpe': 'query', 'sub': 'subscription', 'icc': 'subscription',
+            'ses': 'control', 'res': 'control', 'hb': 'control', 'stop': 'control'}
+
 class FCMCClient:
     '''TCP client to connect with FCMC server'''
 
-    def __init__(self) -> None:
+    def __init__(self, address=TCP_ADDRESS, port=TCP_PORT) -> None:
         #tcp setup
+        self.address = address
+        self.port = port
+        self._connect()
+
+        #session token for a fast resumption after a reconnect and the negotiated heartbeat timeout
+        self.token = None
+        self.heartbeat_timeout = None
+
+        #last message received from the server
+        self.prev_msg = None
+
+        #soft limits configured in the machine axes, built from the first request
+        self.limits = None
+
+        #overlapping pairs reported by the server's interference detection
+        #and an optional callback that is called with the pairs when they change
+        self.interference = []
+        self.on_interference = None
+
+
+
+#-----------------------------------private methods-------------------------------------------
+    def _connect(self):
+        '''open the connection to the fcmc server'''
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((TCP_ADDRESS, TCP_PORT))
+        self.client_socket.connect((self.address, self.port))
+
+        #small requests (heartbeats, updates) are sent right away
+        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         #blocking off: recv does not wait for the server
         #but throws an exception when nothing can be recv'd
         #this is used to sync the server with the client
         self.client_socket.setblocking(False)
 
+        #False once the connection was found to be lost
+        self.alive = True
+
+        #correlation id of the last request, answers that arrived while waiting for another one,
+        #progress callbacks and ids of abandoned requests whose late answers are discarded
+        self._next_id = 0
+        self._answers = {}
+        self._progress = {}
+        self._abandoned = set()
+
+        #id and send time of the update whose acknowledgement is still on its way and the acknowledgement to be checked
+        self._umr_id = None
+        self._umr_sent = 0.0
+        self._ack = None
 
 
-#-----------------------------------private methods-------------------------------------------
     def _sendMessage(self, msg):
         '''method to send a message to fcmc server'''
         #serialize the data to be sent
@@ -34,8 +90,27 @@ class FCMCClient:
         #concatenate the header and the message body
         full_msg = msg_header + myMsg
 
-        #send the message)
-        self.client_socket.send(full_msg)
+        #send the message: large messages may need several attempts on the non-blocking socket
+        view = memoryview(full_msg)
+        try:
+            while view:
+                select.select([], [self.client_socket], [])
+                view = view[self.client_socket.send(view):]
+        except ConnectionError:
+            self.alive = False
+            raise
+
+
+    def _recvExactly(self, length):
+        '''receive exactly length bytes: once a message started to arrive, wait for the rest of it'''
+        data = b""
+        while len(data) < length:
+            select.select([self.client_socket], [], [])
+            part = self.client_socket.recv(length - len(data))
+            if not part:
+                raise ConnectionError("connection closed by the server")
+            data += part
+        return data
 
 
     def _recvMessage(self):
@@ -43,91 +118,281 @@ class FCMCClient:
         try:
             #receive the fixed length header
             message_header = self.client_socket.recv(HEADER_LENGTH)
+            message_header += self._recvExactly(HEADER_LENGTH - len(message_header))
 
             #figure out how long the message body will be
             message_length = int(message_header.decode("utf-8").strip())
 
             #unpickle and return the message
-            return pickle.loads(self.client_socket.recv(message_length))
+            return pickle.loads(self._recvExactly(message_length))
+
+        except BlockingIOError:
+            #nothing to receive
+            return "blocked!"
+
+        except OSError as e:
+            #the server closed the connection or is unreachable: waiting for it is pointless
+            self.alive = False
+            raise ConnectionError("connection to the FCMC server lost") from e
 
         except:
             #something went wrong while receiving
             return "blocked!"
 
 
-    def _sendSCVRequest(self, machAxes):
-        '''request to server: Send Current Values (scv)'''
-        #prepare the request
-        scv_dict = machAxes
+    def _sendRequest(self, request):
+        '''tag a request with a new correlation id and the channel of its type and send it, returns the id'''
+        self._next_id += 1
+        self._sendMessage(dict(request, id=self._next_id, ch=CHANNELS[request['type']]))
+
+        return self._next_id
+
+
+    def _sendUmrRequest(self, targetVals, t):
+        '''request to server: Update Model Request (umr), returns the id of the request'''        
+        #add properties for the request type and the setpoint time to the request
+        return self._sendRequest(dict(targetVals, type='umr', t=t))
+
+
+    def _receive(self):
+        '''receive a frame if there is one and route it by its correlation id: a progress report,
+        the acknowledgement of the update on its way or the answer to a request. Returns the id of the frame'''
+        message = self._recvMessage()
+        if not isinstance(message, dict):
+            #nothing received
+            return None
+
+        req_id = message.pop('id', None)
+        message.pop('ch', None)
+
+        if message.get('type') == 'prg':
+            progress = self._progress.get(req_id)
+            if progress is not None:
+                progress(message['done'], message['total'])
+
+        elif req_id == self._umr_id:
+            #the server is ready for the next update, the acknowledgement is checked by sendValuesToCAD
+            self._umr_id = None
+            self.prev_msg = self._ack = message
+
+        elif req_id in self._abandoned:
+            #late answer to a request that timed out
+            self._abandoned.discard(req_id)
+
+        else:
+            self._answers[req_id] = message
+
+        return req_id
+
+
+    def _checkLimits(self, targetVals, t):
+        '''check target values against the soft limits before they are sent'''
+        if self.limits is None:
+            self.limits = FCMCLimits(targetVals)
+
+        if self.limits:
+            violations = self.limits.check(targetVals, t)
 
-        #add a property for the request type to the request
-        scv_dict["type"] = "scv"
+            if violations:
+                raise FCMCLimitError(violations)
 
-        #send the request to the fcmc server
-        self._sendMessage(scv_dict)
 
-        #delete the 'type' property
-        del scv_dict["type"]
+    def _checkAnswer(self, message):
+        '''raise errors reported by the server and pick up interference reports'''
+        if not isinstance(message, dict):
+            return
 
+        if message.get('type') == 'err':
+            if message['error'] == 'limits':
+                raise FCMCLimitError(message['violations'], "server rejected setpoint")
+            raise RuntimeError("FCMC server error: %s" % message['error'])
 
-    def _sendUmrRequest(self, targetVals):
-        '''request to server: Update Model Request (umr)'''        
-        #prepare the request
-        umr_dict = targetVals
+        if 'interference' in message:
+            self.interference = message['interference']
+            if self.on_interference is not None:
+                self.on_interference(self.interference)
 
-        #add a property for the request type to the request
-        umr_dict['type'] = 'umr'
 
-        #send the request to the fcmc server
-        self._sendMessage(umr_dict)
+    def _checkAck(self):
+        '''check the acknowledgement of the last update, if it arrived'''
+        if self._ack is not None:
+            ack, self._ack = self._ack, None
+            self._checkAnswer(ack)
 
-        #delete the 'type' property
-        del umr_dict['type']
+
+    def _request(self, request, progress=None, timeout=REQUEST_TIMEOUT):
+        '''send a request and wait for the server's answer, matched by its correlation id:
+        acknowledgements of updates on the way are put aside, progress messages are passed to the progress callback.
+        Raises TimeoutError if there is neither the answer nor a progress message within timeout s (None: wait forever)
+        and ConnectionError if the connection is lost'''
+        req_id = self._sendRequest(request)
+        if progress is not None:
+            self._progress[req_id] = progress
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        try:
+            while req_id not in self._answers:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0.0:
+                    #the answer may still arrive: it will be discarded
+                    self._abandoned.add(req_id)
+                    raise TimeoutError("no answer from the FCMC server within %.3g s" % timeout)
+
+                #wait for data instead of spinning, but not beyond the deadline
+                select.select([self.client_socket], [], [], remaining)
+
+                #a progress message shows the server is still working on the request
+                if self._receive() == req_id and timeout is not None:
+                    deadline = time.monotonic() + timeout
+        finally:
+            self._progress.pop(req_id, None)
+
+        message = self._answers.pop(req_id)
+        self._checkAnswer(message)
+
+        return message
 
 
 #-----------------------------------public methods-------------------------------------------
-    def sendValuesToCAD(self, targetVals):
-        '''method to send all values to the FreeCAD server'''
+    def sendValuesToCAD(self, targetVals, t=None):
+        '''method to send all values to the FreeCAD server. t is the time of the setpoint in s
+        (default: now). Values are dropped while the last update is not acknowledged yet.
+        Raises FCMCLimitError if the values violate the configured soft limits, TimeoutError if the last
+        update is not acknowledged within the heartbeat timeout (default: REQUEST_TIMEOUT) and
+        ConnectionError once the connection is lost'''
+        if not self.alive:
+            raise ConnectionError("connection to the FCMC server lost")
+
+        #an acknowledgement may have arrived while waiting for the answer to another request
+        self._checkAck()
+
         #is the server available?
-        if self.prev_msg == "blocked!":
-            pass
+        if self._umr_id is not None:
+            #a server that does not acknowledge in time is stalled: the setpoints would be dropped forever
+            timeout = self.heartbeat_timeout or REQUEST_TIMEOUT
+            if time.monotonic() - self._umr_sent > timeout:
+                self._abandoned.add(self._umr_id)
+                self._umr_id = None
+                self.alive = False
+                raise TimeoutError("update not acknowledged by the FCMC server within %.3g s" % timeout)
         else:
+            #check the soft limits before anything is sent
+            t = time.monotonic() if t is None else t
+            self._checkLimits(targetVals, t)
+
             #FCMC server ready to receive: send Update Model Request 
             #with target values from the configuration object
-            self._sendUmrRequest(targetVals)
+            self._umr_id = self._sendUmrRequest(targetVals, t)
+            self._umr_sent = time.monotonic()
+            self.prev_msg = "blocked!"
 
         #check for acknowledgement from FCMC server
-        self.prev_msg = self._recvMessage()
+        self._receive()
+        self._checkAck()
+
+
+    def getActValues(self, machAxes, timeout=REQUEST_TIMEOUT):
+        '''get the actual CAD model axis positions from the server (Send Current Values, scv).
+        The query does not wait for the acknowledgement of an update on its way.
+        Raises TimeoutError if there is no answer within timeout s'''
+        #the model may have been moved by someone else: build the limits and forget their history
+        self.limits = FCMCLimits(machAxes)
+
+        return self._request(dict(machAxes, type='scv'), timeout=timeout)
+
+
+    def subscribeInterference(self, objects, margin=0.0):
+        '''subscribe to the interference detection of the given objects (list of [docName, label]).
+        Boxes are grown by margin for an early warning. Changes of the overlapping pairs are
+        reported with the acknowledgements of the model updates, see self.interference'''
+        self._request({'type': 'sub', 'topic': 'interference', 'objects': objects, 'margin': margin})
+
+        return self.interference
+
+
+    def checkInterference(self):
+        '''exact shape check of the overlapping pairs (rate-limited by the server):
+        returns a list of (object, object, common volume)'''
+        return self._request({'type': 'icc'})['collisions']
+
+
+    def evaluatePoses(self, machAxes, keys, poses, probes, progress=None, progress_every=100, timeout=REQUEST_TIMEOUT):
+        '''what-if query: let the server apply many machine axis poses and sample the global placement of probe objects.
+        machAxes: dict of the machine axes (docName, object, placementMode), keys: list of (machAx, component, sub)
+        (e.g. FCMCKinematics.mapping.keys), poses: array (poses, len(keys)), probes: list of [docName, label],
+        progress: callback(done, total), called every progress_every poses. The timeout applies to the answer
+        and to every progress message, so long batches do not time out while the server makes progress.
+        Returns an array (poses, probes, 7) of x, y, z and rotation quaternion x, y, z, w.
+        The server restores the original pose afterwards'''
+        request = {
+            'type': 'bpe',
+            'axes': machAxes,
+            'keys': [tuple(key) for key in keys],
+            'poses': np.asarray(poses, dtype=float),
+            'probes': probes,
+            'progress': progress_every,
+        }
+
+        return self._request(request, progress, timeout)['placements']
+
+
+    def openSession(self, heartbeat=None):
+        '''open a session on the server: after a reconnect, resume() restores the axis table, the resolved
+        CAD objects, limits and subscriptions in one round trip. With a heartbeat timeout (s, e.g. HEARTBEAT_TIMEOUT)
+        the server drops the connection if the client is silent for longer: this client sends no heartbeats
+        in the background, heartbeat() or sendValuesToCAD() has to be called more often then'''
+        self.token = self._request({'type': 'ses', 'heartbeat': heartbeat})['token']
+        self.heartbeat_timeout = heartbeat
+
+        return self.token
+
+
+    def heartbeat(self, timeout=None):
+        '''keep the connection alive and check whether the server is: returns the round trip time in s.
+        Raises TimeoutError if the server does not answer within timeout s (default: the negotiated heartbeat timeout)'''
+        timeout = timeout if timeout is not None else self.heartbeat_timeout or HEARTBEAT_TIMEOUT
+
+        t_start = time.perf_counter()
+        self._request({'type': 'hb'}, timeout=timeout)
+
+        return time.perf_counter() - t_start
+
+
+    def resume(self, timeout=REQUEST_TIMEOUT):
+        '''reconnect to the server and resume the session: returns the actual values of the
+        axes (machAxes dict) of the last getActValues request of the session'''
+        if self.token is None:
+            raise RuntimeError("no session to resume, call openSession first")
+
+        try:
+            self.client_socket.close()
+        except OSError:
+            pass
 
+        self._connect()
+        self.prev_msg = None
 
-    def getActValues(self, machAxes):
-        '''get the actual CAD model axis positions from the server'''
-        #create a local variable
-        actAxVals = machAxes
+        #setpoints sent before the break are no reference for velocities
+        if self.limits is not None:
+            self.limits.reset()
 
-        #send the request
-        self._sendSCVRequest(actAxVals)
+        answer = self._request({'type': 'res', 'token': self.token, 'heartbeat': self.heartbeat_timeout}, timeout=timeout)
 
-        #loop control variable
-        answer = False
+        return answer['axes']
 
-        while not answer:
-            try:
-                #receive an answer from the server
-                message = self._recvMessage()
 
-                #is the socket blocked?
-                if not message == "blocked!":
-                    #store the recv'd response in the local variable
-                    actAxVals = message
-                    
-                    #answer successfully recv'd
-                    answer = True
+    def stop(self, machAxes=None, timeout=REQUEST_TIMEOUT):
+        '''priority stop: the server handles the request before the updates queued ahead of it, discards the
+        queued updates of the given axes (machAxes dict, default: all axes of the last getActValues request)
+        and aborts a running batch evaluation. Returns a dict with the held position 'axes' (actual values),
+        the number of 'discarded' updates, the stop 'latency' measured by the server and the round trip time 'rtt' in s'''
+        t_start = time.perf_counter()
+        answer = self._request({'type': 'stop', 'axes': machAxes}, timeout=timeout)
+        answer['rtt'] = time.perf_counter() - t_start
 
-                #remember the received message for the next client-server exchange
-                self.prev_msg = message
+        #the next setpoint does not continue the discarded ones
+        if self.limits is not None:
+            self.limits.reset()
 
-            except:
-                print("Error receiving message")
-        
-        return actAxVals
+        return answer
@@ -0,0 +1,198 @@
+import ast
+import math
+import numpy as np
+
+#functions that may be called inside a transformation expression: name -> (scalar, numpy name)
+FUNCTIONS = {
+    'sin': (math.sin, 'sin'),
+    'cos': (math.cos, 'cos'),
+    'tan': (math.tan, 'tan'),
+    'asin': (math.asin, 'arcsin'),
+    'acos': (math.acos, 'arccos'),
+    'atan': (math.atan, 'arctan'),
+    'atan2': (math.atan2, 'arctan2'),
+    'sqrt': (math.sqrt, 'sqrt'),
+    'hypot': (math.hypot, 'hypot'),
+    'exp': (math.exp, 'exp'),
+    'log': (math.log, 'log'),
+    'radians': (math.radians, 'radians'),
+    'degrees': (math.degrees, 'degrees'),
+    'abs': (abs, 'abs'),
+}
+
+#constants that may be used inside a transformation expression
+CONSTANTS = {
+    'pi': math.pi,
+    'e': math.e,
+}
+
+#syntax elements allowed in a transformation expression
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd)
+
+
+def parseExpression(text):
+    '''parse and validate a transformation expression, return the syntax tree and the names of its free variables'''
+    try:
+        tree = ast.parse(str(text).strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError("invalid transformation expression: '%s'" % text)
+
+    names = set()
+
+    #walk the syntax tree and reject anything that is not plain arithmetic
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError("'%s' is not allowed in transformation expression '%s'" % (type(node).__name__, text))
+
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("only numeric constants are allowed in transformation expression '%s'" % text)
+
+        if isinstance(node, ast.Call):
+            #only calls of known functions with positional arguments
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError("unknown function call in transformation expression '%s'" % text)
+
+        elif isinstance(node, ast.Name) and node.id not in FUNCTIONS and node.id not in CONSTANTS:
+            #a free variable: geo axis or intermediate variable
+            names.add(node.id)
+
+    return tree, names
+
+
+def _scalarNamespace():
+    '''globals for the scalar version of a compiled mapping'''
+    namespace = {name: funcs[0] for name, funcs in FUNCTIONS.items()}
+    namespace.update(CONSTANTS)
+    namespace['__builtins__'] = {}
+    return namespace
+
+
+def _bulkNamespace():
+    '''globals for the vectorized (numpy) version of a compiled mapping'''
+    namespace = {name: getattr(np, funcs[1]) for name, funcs in FUNCTIONS.items()}
+    namespace.update(CONSTANTS)
+    namespace['__builtins__'] = {}
+    return namespace
+
+
+class FCMCMapping:
+    '''Set of transformation expressions compiled once into a single function
+
+    inputs:    ordered list of input variable names (e.g. geo axes)
+    outputs:   ordered list of (key, expression) pairs, the key is only used to label the result
+    variables: optional dict of intermediate variables (name -> expression), which may
+               reference inputs and other variables. They are evaluated in dependency order.'''
+
+    def __init__(self, inputs, outputs, variables=None):
+        self.inputs = list(inputs)
+        self.keys = [key for key, _ in outputs]
+        self.expressions = [str(expr) for _, expr in outputs]
+
+        #parse all intermediate variables
+        var_trees = {}
+        var_names = {}
+        for name, expr in (variables or {}).items():
+            self._checkName(name)
+            if name in self.inputs:
+                raise ValueError("variable '%s' shadows an input of the same name" % name)
+            var_trees[name], var_names[name] = parseExpression(expr)
+
+        for name in self.inputs:
+            self._checkName(name)
+
+        #parse all outputs
+        out_trees = []
+        for expr in self.expressions:
+            tree, names = parseExpression(expr)
+            self._checkNames(names, var_trees, expr)
+            out_trees.append(tree)
+
+        for name in var_trees:
+            self._checkNames(var_names[name], var_trees, variables[name])
+
+        #intermediate variables in the order they have to be evaluated
+        self.order = self._sortVariables(var_names)
+
+        #generate the source of the function only once and compile it in two flavours
+        self.source = self._generateSource(var_trees, out_trees)
+        self._scalar = self._compile(_scalarNamespace())
+        self._bulk = None
+
+
+    def _checkName(self, name):
+        '''make sure a variable name can be used inside an expression'''
+        if not str(name).isidentifier() or name in FUNCTIONS or name in CONSTANTS:
+            raise ValueError("'%s' cannot be used as a variable name in transformation expressions" % name)
+
+
+    def _checkNames(self, names, var_trees, expr):
+        '''make sure every free variable of an expression is defined'''
+        for name in names:
+            if name not in self.inputs and name not in var_trees:
+                raise ValueError("unknown name '%s' in transformation expression '%s'" % (name, expr))
+
+
+    def _sortVariables(self, var_names):
+        '''topological sort of the intermediate variables (depth first), cycles are rejected'''
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError("circular dependency between variables: %s" % " -> ".join(path + [name]))
+
+            state[name] = 'visiting'
+            for dep in sorted(var_names[name]):
+                if dep in var_names:
+                    visit(dep, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in var_names:
+            visit(name, [])
+
+        return order
+
+
+    def _generateSource(self, var_trees, out_trees):
+        '''generate the python source of the compiled mapping function'''
+        lines = ["def _fcmc_mapping(%s):" % ", ".join(self.inputs)]
+
+        for name in self.order:
+            lines.append("    %s = %s" % (name, ast.unparse(var_trees[name].body)))
+
+        results = [ast.unparse(tree.body) for tree in out_trees]
+        lines.append("    return (%s%s)" % (", ".join(results), "," if len(results) == 1 else ""))
+
+        return "\n".join(lines)
+
+
+    def _compile(self, namespace):
+        '''compile the generated source with the given function namespace'''
+        exec(compile(self.source, "<fcmc mapping>", "exec"), namespace)
+        return namespace['_fcmc_mapping']
+
+
+    def evaluate(self, values):
+        '''evaluate the mapping for a single set of inputs given as a sequence in input order'''
+        return self._scalar(*values)
+
+
+    def evaluateBulk(self, values):
+        '''evaluate the mapping for many sets of inputs at once:
+        values is an array of shape (n, len(inputs)), the result has shape (n, len(outputs))'''
+        if self._bulk is None:
+            self._bulk = self._compile(_bulkNamespace())
+
+        values = np.asarray(values, dtype=float).reshape(-1, len(self.inputs))
+
+        #columns of constant expressions come back as scalars: broadcast them to full length
+        columns = self._bulk(*values.T)
+        result = np.empty((values.shape[0], len(columns)))
+        for i, column in enumerate(columns):
+            result[:, i] = column
+
+        return result
@@ -0,0 +1,343 @@
+import math
+import re
+import time
+import numpy as np
+from fcmclimits import FCMCLimits, FCMCLimitError
+
+#feed rate (units/min) used for rapid traverse moves (G0)
+RAPID_FEED = 5000.0
+
+#default time between two setpoints in s
+TICK = 0.02
+
+#default number of setpoints that are computed ahead in one vectorized pass
+LOOKAHEAD = 256
+
+#axis words that may appear in a program
+AXIS_WORDS = "XYZABCUVW"
+
+#a word of a G-code block: address letter and number
+_WORD = re.compile(r'([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+
+#comments: in parentheses or from a semicolon to the end of the line
+_COMMENT = re.compile(r'\([^)]*\)|;.*')
+
+#working planes G17, G18, G19: first axis, second axis and the corresponding arc center words
+_PLANES = {
+    17: ('X', 'Y', 'I', 'J'),
+    18: ('Z', 'X', 'K', 'I'),
+    19: ('Y', 'Z', 'J', 'K'),
+}
+
+
+def readGcode(path):
+    '''lazily read a G-code program line by line, so that programs of any size use constant memory'''
+    with open(path) as program:
+        for line in program:
+            yield line
+
+
+def parseGcode(lines, start=None):
+    '''parse G-code blocks into moves (generator). Supported: G0/G1/G2/G3 moves, G4 dwell,
+    G17/G18/G19 planes, G20/G21 units (converted to mm), G90/G91 distance mode, G90.1/G91.1 arc center mode
+    and F feed rate. Other decimal G-codes (e.g. G38.2 probing) are rejected with a ValueError. Every move is a dict with the keys motion, start, end, feed and line number,
+    arcs additionally carry the plane and the absolute arc center.'''
+    #modal state of the interpreter
+    motion = 0
+    absolute = True
+    absolute_center = False
+    scale = 1.0
+    plane = 17
+    feed = None
+    position = {axis: 0.0 for axis in AXIS_WORDS}
+    position.update(start or {})
+
+    for number, line in enumerate(lines, 1):
+        #strip comments and split the block into words
+        words = _WORD.findall(_COMMENT.sub('', line).upper())
+        if not words:
+            continue
+
+        target = {}
+        offsets = {}
+        radius = None
+        dwell = False
+        pause = 0.0
+        has_motion = False
+
+        for letter, text in words:
+            value = float(text)
+
+            if letter == 'G' and value != int(value):
+                #decimal codes are no variants of the integer code: G91.1 must not switch to incremental distances
+                if value in (90.1, 91.1):
+                    absolute_center = value == 90.1
+                else:
+                    raise ValueError("unsupported G-code G%s in line %d" % (text, number))
+
+            elif letter == 'G':
+                code = int(value)
+                if code in (0, 1, 2, 3):
+                    motion = code
+                    has_motion = True
+                elif code == 4:
+                    dwell = True
+                elif code in _PLANES:
+                    plane = code
+                elif code in (20, 21):
+                    scale = 25.4 if code == 20 else 1.0
+                elif code in (90, 91):
+                    absolute = code == 90
+
+            elif letter in AXIS_WORDS:
+                target[letter] = value * scale if letter in "XYZUVW" else value
+            elif letter in "IJK":
+                offsets[letter] = value * scale
+            elif letter == 'R':
+                radius = value * scale
+            elif letter == 'F':
+                feed = value * scale
+            elif letter == 'P':
+                #the dwell time may precede G4 in the block
+                pause = value
+
+        if dwell:
+            #dwell: no motion, only time passes
+            yield {'motion': 4, 'duration': pause, 'line': number}
+            continue
+
+        if not target and not has_motion:
+            continue
+
+        #resolve the end position of the move
+        end = dict(position)
+        for axis, value in target.items():
+            end[axis] = value if absolute else position[axis] + value
+
+        move = {'motion': motion, 'start': position, 'end': end, 'feed': feed, 'line': number}
+
+        if motion in (2, 3):
+            move['plane'] = plane
+            move['center'] = _arcCenter(move, offsets, radius, absolute_center)
+
+        position = end
+        yield move
+
+
+def _arcCenter(move, offsets, radius, absolute_center=False):
+    '''absolute center of an arc, given by center offsets (I, J, K), absolute center coordinates (G90.1)
+    or by a radius (R)'''
+    ax1, ax2, off1, off2 = _PLANES[move['plane']]
+    start, end = move['start'], move['end']
+
+    if radius is None:
+        if absolute_center:
+            return (offsets.get(off1, 0.0), offsets.get(off2, 0.0))
+        return (start[ax1] + offsets.get(off1, 0.0), start[ax2] + offsets.get(off2, 0.0))
+
+    #radius format: the center lies on the perpendicular bisector of the chord
+    d1, d2 = end[ax1] - start[ax1], end[ax2] - start[ax2]
+    chord = math.hypot(d1, d2)
+    if chord == 0.0 or chord > 2 * abs(radius) + 1e-9:
+        raise ValueError("invalid arc radius in line %d" % move['line'])
+
+    #negative radius: arc > 180 degrees, G2 (clockwise) puts the center to the right of the chord
+    height = math.sqrt(max(radius ** 2 - chord ** 2 / 4, 0.0))
+    side = (1 if move['motion'] == 3 else -1) * (1 if radius > 0 else -1)
+
+    return (start[ax1] + d1 / 2 - side * height * d2 / chord,
+            start[ax2] + d2 / 2 + side * height * d1 / chord)
+
+
+class FCMCGcodeInterpreter:
+    '''Stream a G-code program as time-parameterized setpoints through the kinematics to the FCMC server
+
+    kinematics: FCMCKinematics object of the CAD model
+    axis_map:   dict of program axis words -> geo axis names, e.g. {"X": "X", "Y": "Y", "A": "A"}
+    client:     FCMCClient object (None for dry runs)'''
+
+    def __init__(self, kinematics, axis_map, client=None, tick=TICK, lookahead=LOOKAHEAD, rapid_feed=RAPID_FEED):
+        self.kinematics = kinematics
+        self.client = client
+        self.tick = tick
+        self.lookahead = lookahead
+        self.rapid_feed = rapid_feed
+
+        #program axes that drive a configured geo axis and the column of that geo axis
+        geo_names = self.kinematics.mapping.inputs
+        for axis, geo in axis_map.items():
+            if geo not in geo_names:
+                raise ValueError("program axis %s is mapped to unknown geo axis '%s'" % (axis, geo))
+        self.axis_map = {axis.upper(): geo_names.index(geo) for axis, geo in axis_map.items()}
+
+        #soft limits of the machine axes: every chunk of setpoints is validated before it is sent
+        self.limits = FCMCLimits(self.kinematics.mach_axes)
+
+
+    def _geoVector(self, position, base):
+        '''geo axis vector of a program position, unmapped geo axes keep their value from base'''
+        vector = np.array(base, dtype=float)
+        for axis, column in self.axis_map.items():
+            vector[column] = position[axis]
+        return vector
+
+
+    def _interpolate(self, move, u, start, end):
+        '''geo axis positions of a move at the normalized times u (0..1), vectorized'''
+        positions = start + np.outer(u, end - start)
+
+        if move['motion'] in (2, 3):
+            ax1, ax2, _, _ = _PLANES[move['plane']]
+            sweep, angle0, radius0, radius1 = move['arc']
+            center = move['center']
+
+            #angle and radius of the arc at the sample times (the radius blends between start and end)
+            angle = angle0 + u * sweep
+            radius = radius0 + u * (radius1 - radius0)
+
+            if ax1 in self.axis_map:
+                positions[:, self.axis_map[ax1]] = center[0] + radius * np.cos(angle)
+            if ax2 in self.axis_map:
+                positions[:, self.axis_map[ax2]] = center[1] + radius * np.sin(angle)
+
+        return positions
+
+
+    def _prepareMove(self, move):
+        '''calculate length and duration of a move'''
+        start, end = move['start'], move['end']
+
+        if move['motion'] in (2, 3):
+            ax1, ax2, _, _ = _PLANES[move['plane']]
+            c1, c2 = move['center']
+            angle0 = math.atan2(start[ax2] - c2, start[ax1] - c1)
+            angle1 = math.atan2(end[ax2] - c2, end[ax1] - c1)
+            radius0 = math.hypot(start[ax1] - c1, start[ax2] - c2)
+            radius1 = math.hypot(end[ax1] - c1, end[ax2] - c2)
+
+            #G2 sweeps clockwise (negative), G3 counterclockwise; identical start and end: full circle
+            sweep = angle1 - angle0
+            if move['motion'] == 2:
+                sweep = sweep - 2 * math.pi if sweep >= 0 else sweep
+            else:
+                sweep = sweep + 2 * math.pi if sweep <= 0 else sweep
+
+            move['arc'] = (sweep, angle0, radius0, radius1)
+            planar = abs(sweep) * (radius0 + radius1) / 2
+            other = [end[axis] - start[axis] for axis in "XYZ" if axis not in (ax1, ax2)]
+            length = math.hypot(planar, *other)
+        else:
+            #the feed rate applies to the linear axes, pure rotary moves use the rotary distance
+            length = math.dist([start[axis] for axis in "XYZ"], [end[axis] for axis in "XYZ"])
+            if length == 0.0:
+                length = math.dist([start[axis] for axis in "ABC"], [end[axis] for axis in "ABC"])
+
+        feed = self.rapid_feed if move['motion'] == 0 else move['feed']
+        if not feed:
+            raise ValueError("no feed rate programmed for the move in line %d" % move['line'])
+
+        return length / feed * 60.0
+
+
+    def setpoints(self, lines):
+        '''generator of time-parameterized geo axis setpoints: yields chunks of (times, positions)
+        with up to lookahead setpoints each. Setpoints are equidistant in time across move boundaries.'''
+        base = np.array(self.kinematics.geoAxValues())
+        start_pos = {axis: base[column] for axis, column in self.axis_map.items()}
+
+        #time at the start of the current move and index of the next setpoint
+        t_move = 0.0
+        index = 1
+        current = base
+
+        for move in parseGcode(lines, start_pos):
+            if move['motion'] == 4:
+                #dwell: hold the current position
+                duration = move['duration']
+                start = end = current
+            else:
+                duration = self._prepareMove(move)
+                start = self._geoVector(move['start'], base)
+                end = self._geoVector(move['end'], base)
+
+            t_end = t_move + duration
+
+            #sample the move in chunks of at most lookahead setpoints
+            last = int(math.floor(t_end / self.tick + 1e-9))
+            while index <= last:
+                indices = np.arange(index, min(index + self.lookahead, last + 1))
+                times = indices * self.tick
+                u = (times - t_move) / duration if duration > 0 else np.ones(len(times))
+
+                yield times, self._interpolate(move, np.clip(u, 0.0, 1.0), start, end)
+                index = indices[-1] + 1
+
+            t_move = t_end
+            current = end
+
+        #make sure the final position is reached exactly
+        if (index - 1) * self.tick < t_move:
+            yield np.array([t_move]), current[None, :]
+
+
+    def machSetpoints(self, lines):
+        '''generator of time-parameterized machine axis setpoints in the order of mapping.keys.
+        Raises FCMCLimitError before a chunk that violates the soft limits is handed out'''
+        keys = self.kinematics.mapping.keys
+
+        #the last two setpoints of the previous chunk, so velocity and acceleration are checked across chunks
+        tail_times = np.empty(0)
+        tail = np.empty((0, len(keys)))
+        count = 0
+
+        for times, positions in self.setpoints(lines):
+            mach = self.kinematics.calcMachAxValuesBulk(positions)
+
+            if self.limits:
+                violations = self.limits.checkTrajectory(np.vstack([tail, mach]), np.append(tail_times, times), keys)
+                violations = [v for v in violations if v['index'] >= len(tail_times)]
+
+                if violations:
+                    #index of the offending setpoint within the whole program
+                    for v in violations:
+                        v['index'] += count - len(tail_times)
+                    raise FCMCLimitError(violations, "program violates soft limits")
+
+                tail_times = np.append(tail_times, times)[-2:]
+                tail = np.vstack([tail, mach])[-2:]
+
+            count += len(times)
+            yield times, positions, mach
+
+
+    def run(self, lines, realtime=True):
+        '''stream a program (iterable of lines, e.g. readGcode(path)) through the client.
+        With realtime False the setpoints are sent as fast as possible (dry run).
+        Returns the number of setpoints, the program duration and the wall clock time in s.'''
+        count = 0
+        t_program = 0.0
+        t_start = time.monotonic()
+        positions = None
+
+        for times, positions, mach in self.machSetpoints(lines):
+            for t, values in zip(times, mach):
+                if realtime:
+                    #wait for the setpoint's point in time
+                    delay = t_start + t - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                if self.client is not None:
+                    #send one combined update of all machine axes
+                    self.kinematics.setMachAxValues(values)
+                    self.client.sendValuesToCAD(self.kinematics.mach_axes, t_start + t)
+
+            count += len(times)
+            t_program = float(times[-1])
+
+        #the geo axes of the configuration object follow the program
+        if positions is not None:
+            self.kinematics.setGeoAxValues(positions[-1])
+            self.kinematics.calcAxValues("machAxes")
+
+        return {'setpoints': count, 'program_time': t_program, 'wall_time': time.monotonic() - t_start}
@@ -1,3 +1,16 @@
+import numpy as np
+from fcmcexpression import FCMCMapping
+
+#tolerance for the linearity and consistency checks of the inverse mapping
+INV_TOL = 1e-9
+
+#step width for numerical derivatives of non-linear transformations
+INV_STEP = 1e-6
+
+#maximum number of Gauss-Newton iterations for non-linear transformations
+INV_MAX_ITER = 50
+
+
 class FCMCKinematics:
     '''Provide a link between logical geometry axes and actual CAD machine axes'''
 
@@ -10,47 +23,180 @@ class FCMCKinematics:
         self.geo_axes = self.cad_config['geoAxes']
         self.mach_axes = self.cad_config['machAxes']
 
+        #parse and compile the machine axis transformations once
+        self.mapping = self._compileMachMapping()
+
+        #inverse of the mapping: derived on first use, then cached
+        self.inverse = None
+
+
+    def _compileMachMapping(self):
+        '''compile the transformations of all machine axis (sub)components into a single mapping.
+        A transformation is either an expression string (e.g. "0.5*X + 10") or a factor and a source geo axis'''
+        outputs = []
+
+        for axis in self.transformations:
+            #only transformations of configured machine axes are relevant
+            if axis not in self.mach_axes:
+                continue
+
+            for component in self.transformations[axis]:
+                for sub, trafo in self.transformations[axis][component].items():
+                    if isinstance(trafo, dict):
+                        #factor and source: translate into the equivalent expression
+                        trafo = "%s * %s" % (float(trafo['factor']), trafo['source'][1])
+
+                    outputs.append(((axis, component, sub), trafo))
+
+        return FCMCMapping(self.geo_axes.keys(), outputs, self.cad_config.get('variables'))
+
+
+    def geoAxValues(self):
+        '''get the current geo axis values in the input order of the compiled mapping'''
+        return [float(self.geo_axes[geo]['value']) for geo in self.mapping.inputs]
+
+
+    def _calculateMachAxValues(self):
+        '''calculate all machine axis values from the geo axis values with the compiled mapping'''
+        self.setMachAxValues(self.mapping.evaluate(self.geoAxValues()))
+
+
+    def _machAxValues(self, mach_axes):
+        '''get machine axis values (e.g. from an scv result) in the output order of the compiled mapping'''
+        return [float(mach_axes[axis][component][sub]) for axis, component, sub in self.mapping.keys]
+
+
+    def _jacobianBulk(self, geo):
+        '''numerical jacobian of the forward mapping for many geo positions, shape (n, outputs, inputs)'''
+        n_in = len(self.mapping.inputs)
+
+        #evaluate the mapping at every position and at every position shifted along each geo axis
+        shifted = geo[:, None, :] + np.eye(n_in) * INV_STEP
+        base = self.mapping.evaluateBulk(geo)
+        moved = self.mapping.evaluateBulk(shifted.reshape(-1, n_in)).reshape(len(geo), n_in, -1)
+
+        return ((moved - base[:, None, :]) / INV_STEP).transpose(0, 2, 1)
+
+
+    def _unobservableAxes(self, jacobian):
+        '''geo axes that have a component in the null space of the jacobian'''
+        _, sing, vt = np.linalg.svd(jacobian)
+        rank = int(np.sum(sing > INV_TOL * max(1.0, sing.max(initial=0.0))))
+        null_space = vt[rank:]
+
+        return [geo for i, geo in enumerate(self.mapping.inputs) if np.linalg.norm(null_space[:, i]) > INV_TOL]
+
+
+    def _buildInverse(self):
+        '''derive the inverse of the compiled forward mapping and check the configuration for problems'''
+        n_in = len(self.mapping.inputs)
+        issues = []
+
+        if not self.mapping.keys:
+            raise ValueError("no machine axis transformations configured")
+
+        #probe the mapping at the origin, along every geo axis and at an arbitrary test position
+        test = np.linspace(0.5, 1.5, n_in) * np.sign(np.arange(n_in) % 2 - 0.5)
+        probes = np.vstack([np.zeros(n_in), np.eye(n_in), test])
+
+        with np.errstate(all='ignore'):
+            results = self.mapping.evaluateBulk(probes)
+            offset = results[0]
+            jacobian = (results[1:n_in + 1] - offset).T
+            linear = bool(np.all(np.isfinite(results)) and
+                          np.allclose(jacobian @ test + offset, results[-1], rtol=INV_TOL, atol=INV_TOL))
+
+        inverse = {'linear': linear, 'offset': offset, 'pinv': None}
+
+        if linear:
+            #affine mapping: the least squares inverse is solved once
+            inverse['pinv'] = np.linalg.pinv(jacobian)
+        else:
+            #non-linear mapping: check observability at the current position instead
+            jacobian = self._jacobianBulk(np.array([self.geoAxValues()]))[0]
+
+        #geo axes that do not (uniquely) influence any machine axis cannot be reconstructed
+        inverse['unobservable'] = self._unobservableAxes(jacobian)
+        if inverse['unobservable']:
+            issues.append("underdetermined: geo axes %s cannot be reconstructed from the machine axes"
+                          % ", ".join(inverse['unobservable']))
+
+        self.inverse = inverse
+
+        #explicitly configured inverse transformations (factor and source) have to agree with the derived inverse
+        mach = dict(zip(self.mapping.keys, self.mapping.evaluate(test)))
+        for i, geo in enumerate(self.mapping.inputs):
+            trafo = self.transformations.get(geo)
+            if trafo is None or geo in inverse['unobservable']:
+                continue
+
+            value = float(trafo['factor']) * mach.get(tuple(trafo['source'][1:]), np.nan)
+            if not np.isclose(value, test[i], rtol=1e-6, atol=1e-6):
+                issues.append("inconsistent: configured transformation of geo axis %s does not invert the machine axis transformations" % geo)
+
+        inverse['issues'] = issues
+        return inverse
+
+
+    def inverseIssues(self):
+        '''get a list of problems of the configuration concerning the reconstruction of geo axes (empty if none)'''
+        if self.inverse is None:
+            self._buildInverse()
+
+        return self.inverse['issues']
+
+
+    def machAxValueArray(self, mach_axes_list):
+        '''convert a list of machine axis dicts (e.g. scv results) into an array of shape (n, number of transformations)'''
+        return np.array([self._machAxValues(mach_axes) for mach_axes in mach_axes_list], dtype=float)
+
+
+    def calcGeoAxValuesBulk(self, mach_values, initial=None):
+        '''reconstruct geo axis positions from many machine axis positions at once.
+        mach_values has shape (n, number of transformations) in the order of mapping.keys.
+        Returns the geo positions, shape (n, number of geo axes), and the residual of each position:
+        a residual > 0 means the machine axis values are not consistent with any geo position'''
+        if self.inverse is None:
+            self._buildInverse()
+
+        mach = np.asarray(mach_values, dtype=float).reshape(-1, len(self.mapping.keys))
+
+        if self.inverse['linear']:
+            #affine mapping: apply the cached pseudo-inverse
+            geo = (mach - self.inverse['offset']) @ self.inverse['pinv'].T
+        else:
+            #non-linear mapping: Gauss-Newton iteration for all positions in parallel
+            if initial is None:
+                initial = self.geoAxValues()
+            geo = np.tile(np.asarray(initial, dtype=float), (len(mach), 1))
+
+            for _ in range(INV_MAX_ITER):
+                error = self.mapping.evaluateBulk(geo) - mach
+                step = np.einsum('kij,kj->ki', np.linalg.pinv(self._jacobianBulk(geo)), error)
+                geo -= step
+
+                if np.max(np.abs(step), initial=0.0) < INV_TOL:
+                    break
+
+        residual = np.linalg.norm(self.mapping.evaluateBulk(geo) - mach, axis=1)
+        return geo, residual
+
 
-    def _calculateGeoAxValue(self, axis):
-        '''calculate geometry axis value from the defined source and correction factor for a given axis'''
-        #grab factor and source from configuration object
-        src_list = self.transformations[axis]['source']
-        factor = float(self.transformations[axis]['factor'])
-        source = float(self.mach_axes[src_list[1]][src_list[2]][src_list[3]])
-
-        #calculate geometry axis value
-        self.geo_axes[axis]['value'] = factor * source
-
-
-    def _calculateMachAxValue(self, axis):
-        '''calculate machine axis value from the defined source and correction factor for a given axis'''
-        #check for manipulations in placement and rotation (sub)somponents
-        for component in self.transformations[axis]:
-            for sub in self.transformations[axis][component]:
-                #grab factor and source from configuration object
-                src_list = self.transformations[axis][component][sub]['source']
-                factor = float(self.transformations[axis][component][sub]['factor'])
-                source = float(self.geo_axes[src_list[1]][src_list[2]])
-                
-                #calculate the machine axis sub-component axis value (e.g. placement.x)
-                self.mach_axes[axis][component][sub] = factor * source
-   
-    
     def calcAxValues(self, axis_type):
         '''Depending on axis_type: Calculate geo axis values from machine axis values or vice versa'''
         try:
-            #iterate through all configured axes
-            for axis in self.transformations:
-                #differentiate the whether geo or machine axis are to be calculated
-                #and check if a axis that was configured in th etransformations is also configured in geoAxes or machAxes
-                
-                if axis_type == "geoAxes" and axis in self.geo_axes:
-                    #calculate the value of a geometry axis
-                    self._calculateGeoAxValue(axis)
-                
-                elif axis_type == "machAxes" and axis in self.mach_axes:
-                    #calculate the value of a machine axis
-                    self._calculateMachAxValue(axis)
+            if axis_type == "machAxes":
+                #calculate the values of all machine axes in one pass
+                self._calculateMachAxValues()
+
+            elif axis_type == "geoAxes":
+                #reconstruct the geo axis values from the machine axis values
+                geo, _ = self.calcGeoAxValuesBulk([self._machAxValues(self.mach_axes)], self.geoAxValues())
+
+                #axes that cannot be reconstructed keep their value
+                for value, axis in zip(geo[0], self.mapping.inputs):
+                    if axis not in self.inverse['unobservable']:
+                        self.geo_axes[axis]['value'] = float(value)
 
         except:
             pass
@@ -70,6 +216,46 @@ class FCMCKinematics:
         return geo_dict.keys()
 
 
+    def calcMachAxValuesBulk(self, geo_values):
+        '''calculate machine axis values for many geo axis positions at once (vectorized).
+        geo_values has shape (n, number of geo axes) in the order of mapping.inputs,
+        the result has shape (n, number of transformations) in the order of mapping.keys'''
+        return self.mapping.evaluateBulk(geo_values)
+
+
     def setGeoAxValue(self, geo, value):
         '''update the value of a given geometry axis in the configuration object'''
-        self.cad_config['geoAxes'][geo]['value'] = value
\ No newline at end of file
+        self.cad_config['geoAxes'][geo]['value'] = value
+
+
+    def setMachAxValues(self, values):
+        '''write machine axis values given in the order of mapping.keys (e.g. one row of a bulk result)
+        to the machine axis (sub)components (e.g. placement.x) in the configuration object'''
+        for (axis, component, sub), value in zip(self.mapping.keys, values):
+            self.mach_axes[axis][component][sub] = float(value)
+
+
+    def mergeMachAxValues(self, actual):
+        '''take over the actual values of machine axes reported by the server (machAxes dict, e.g. the held position
+        of a stop). FreeCAD reports a negative rotation as a positive angle about the flipped axis: in axisangle mode
+        the angle is related to the configured rotation axis, which is kept'''
+        for axis, values in actual.items():
+            axis_dict = self.mach_axes[axis]
+
+            if axis_dict.get('placementMode', 'axisangle') != 'axisangle':
+                #full precision modes are unambiguous
+                axis_dict.update(values)
+                continue
+
+            axis_dict['placement'].update(values['placement'])
+
+            rotation = axis_dict['rotation']
+            direction = sum(float(rotation[sub]) * values['rotation'][sub] for sub in 'xyz')
+            angle = values['rotation']['angle']
+            rotation['angle'] = -angle if direction < 0 else angle
+
+
+    def setGeoAxValues(self, values):
+        '''update the values of all geometry axes given in the order of mapping.inputs'''
+        for geo, value in zip(self.mapping.inputs, values):
+            self.geo_axes[geo]['value'] = float(value)
\ No newline at end of file
@@ -0,0 +1,161 @@
+import math
+import time
+import numpy as np
+from fcmclimits import FCMCLimits, FCMCLimitError
+
+#default time between two setpoints in s
+TICK = 0.02
+
+
+class FCMCMotion:
+    '''Coordinated moves of several geo axes: all axes start and arrive at the same time
+
+    kinematics: FCMCKinematics object of the CAD model
+    client:     FCMCClient object (None to only plan moves)'''
+
+    def __init__(self, kinematics, client=None, tick=TICK):
+        self.kinematics = kinematics
+        self.client = client
+        self.tick = tick
+
+        #soft limits of the machine axes: every move is validated before it starts
+        self.limits = FCMCLimits(self.kinematics.mach_axes)
+
+        #active move: setpoint times, machine axis setpoints and geo axis positions
+        self.plan = None
+        self.t_start = None
+        self.last_index = -1
+
+
+    def _profile(self, times, length, speed, accel):
+        '''distance along the path at the given times: trapezoidal velocity profile,
+        or constant velocity if accel is None'''
+        if accel is None:
+            return np.minimum(times * speed, length)
+
+        #short moves do not reach the programmed speed: triangular profile
+        speed = min(speed, math.sqrt(length * accel))
+        t_acc = speed / accel
+        duration = length / speed + t_acc
+
+        return np.select([times < t_acc, times < duration - t_acc, times < duration],
+                         [0.5 * accel * times ** 2,
+                          speed * (times - t_acc / 2),
+                          length - 0.5 * accel * (duration - times) ** 2],
+                         length)
+
+
+    def planMove(self, target, feed, accel=None):
+        '''plan a synchronized move to a target pose (dict of geo axes -> values) with the feed rate
+        (units/min along the path) and an optional acceleration (units/s^2).
+        All setpoints are calculated ahead of time in one vectorized pass and checked against the soft limits.
+        Returns the setpoint times (s), the geo axis positions and the machine axis values (order of mapping.keys)'''
+        geo_names = self.kinematics.mapping.inputs
+        for geo in target:
+            if geo not in geo_names:
+                raise ValueError("unknown geo axis '%s'" % geo)
+
+        if feed <= 0:
+            raise ValueError("the feed rate has to be positive")
+
+        start = np.array(self.kinematics.geoAxValues())
+        end = np.array([float(target.get(geo, value)) for geo, value in zip(geo_names, start)])
+
+        #the feed rate applies to the path through all moved geo axes
+        length = float(np.linalg.norm(end - start))
+        speed = feed / 60.0
+
+        if length == 0.0:
+            times = np.zeros(1)
+            u = np.ones(1)
+        else:
+            duration = length / speed + (0.0 if accel is None else min(speed, math.sqrt(length * accel)) / accel)
+            times = np.append(np.arange(1, int(math.ceil(duration / self.tick))) * self.tick, duration)
+            u = self._profile(times, length, speed, accel) / length
+
+        #every axis covers the same fraction of its distance at the same time
+        positions = start + np.outer(u, end - start)
+        mach = self.kinematics.calcMachAxValuesBulk(positions)
+
+        if self.limits:
+            #the current position is the first point of the trajectory
+            current = self.kinematics.calcMachAxValuesBulk(start[None, :])
+            violations = self.limits.checkTrajectory(np.vstack([current, mach]), np.append(0.0, times),
+                                                     self.kinematics.mapping.keys)
+            if violations:
+                raise FCMCLimitError(violations, "move violates soft limits")
+
+        return times, positions, mach
+
+
+    def moveTo(self, target, feed, accel=None):
+        '''plan a synchronized move and make it the active move, which is sent by calling step() every tick'''
+        times, positions, mach = self.planMove(target, feed, accel)
+
+        self.plan = (times, mach, positions)
+        self.t_start = None
+        self.last_index = -1
+
+
+    def step(self):
+        '''send the setpoint of the active move that is due now as one combined update of all axes.
+        Returns False when the move is complete (or there is none)'''
+        if self.plan is None:
+            return False
+
+        times, mach, positions = self.plan
+        now = time.monotonic()
+
+        if self.t_start is None:
+            self.t_start = now
+
+        #latest setpoint that is due: late ticks skip setpoints, but never the final one
+        index = max(int(np.searchsorted(times, now - self.t_start, side='right')) - 1, 0)
+
+        if index == self.last_index:
+            return True
+
+        #the client only sends if the server acknowledged the previous update
+        sent = self.client is None or self.client.prev_msg != "blocked!"
+
+        self.kinematics.setMachAxValues(mach[index])
+        if self.client is not None:
+            self.client.sendValuesToCAD(self.kinematics.mach_axes, self.t_start + times[index])
+
+        if sent:
+            self.last_index = index
+
+            if index == len(times) - 1:
+                #move complete: the geo axes of the configuration object follow
+                self.kinematics.setGeoAxValues(positions[-1])
+                self.plan = None
+                return False
+
+        return True
+
+
+    def stop(self):
+        '''abandon the active move. With a client, the server discards the setpoints still queued and
+        reports the held position, which the axes of the configuration object follow (returns the server's answer).
+        Otherwise the axes stay at the last sent setpoint'''
+        answer = None
+
+        if self.client is not None:
+            answer = self.client.stop(self.kinematics.mach_axes)
+            self.kinematics.mergeMachAxValues(answer['axes'])
+            self.kinematics.calcAxValues("geoAxes")
+
+        elif self.plan is not None and self.last_index >= 0:
+            #the geo axes of the configuration object follow the last sent setpoint
+            self.kinematics.setGeoAxValues(self.plan[2][self.last_index])
+
+        self.plan = None
+        return answer
+
+
+    def run(self, target, feed, accel=None):
+        '''execute a synchronized move and wait until it is complete'''
+        self.moveTo(target, feed, accel)
+
+        while self.step():
+            time.sleep(self.tick / 2)
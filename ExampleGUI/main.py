@@ -5,6 +5,7 @@ from PyQt5 import QtGui, QtCore
 from PyQt5.QtCore import QTimer, qDebug
 from PyQt5.QtGui import QCursor
 from fcmcclient import FCMCClient
+from fcmclimits import FCMCLimitError
 from fcmcconfig import FCMCConfig as config
 from fcmckinematics import FCMCKinematics as kinematics
 
@@ -42,6 +43,9 @@ class ExampleGui(QMainWindow):
         #dictionary to house list of setup info by axis label
         self.axis_setup = {}
 
+        #latency of the last stop (s): from the arrival of the stop at the server to its confirmation, and round trip
+        self.stop_latency = None
+
         self.initUI()
 
     
@@ -55,7 +59,24 @@ class ExampleGui(QMainWindow):
         self.kine_handler.calcAxValues("machAxes")
 
         #send all machine axis values in the configuration object to the fcmc server
-        self.fcmc.sendValuesToCAD(self.cad_config['machAxes'])
+        try:
+            self.fcmc.sendValuesToCAD(self.cad_config['machAxes'])
+        except FCMCLimitError as e:
+            #soft limit reached: stop jogging and fall back to the last valid position
+            print(e)
+            self.timer.stop()
+            self.target_pos = self.act_pos
+            self.kine_handler.setGeoAxValue(self.axis_sel.currentText(), self.act_pos)
+            self.kine_handler.calcAxValues("machAxes")
+            return
+        except ConnectionError as e:
+            #the server is gone: stop jogging
+            print(e)
+            self.timer.stop()
+            return
+
+        #remember the last position that was accepted
+        self.act_pos = tar_pos
 
         #display new position value in GUI
         self.pos.setText(str(tar_pos))
@@ -110,7 +131,23 @@ class ExampleGui(QMainWindow):
 
         #disconnect slots
         self.timer.disconnect()
-        
+
+        #setpoints still on their way must not play out: stop the axes at their actual position
+        try:
+            answer = self.fcmc.stop(self.cad_config['machAxes'])
+        except (TimeoutError, ConnectionError) as e:
+            #the server did not confirm the stop: keep the last accepted position
+            print(e)
+            return
+
+        self.stop_latency = (answer['latency'], answer['rtt'])
+        self.stop_lat.setText("stop %.1f ms" % (answer['rtt'] * 1000))
+
+        #the configuration object and the position display follow the held position
+        self.kine_handler.mergeMachAxValues(answer['axes'])
+        self.kine_handler.calcAxValues("geoAxes")
+        self.setActualPosLabel()
+
 
     def connectFCMC(self):
         '''method to handle connection to FCMC server'''
@@ -186,7 +223,7 @@ class ExampleGui(QMainWindow):
         geo = self.axis_sel.currentText()
 
         #set target position value to the value of the selected axis
-        self.target_pos = self.kine_handler.axis_pos(geo)
+        self.target_pos = self.act_pos = self.kine_handler.axis_pos(geo)
 
         #set the actual pos display label
         self.pos.setText(str(self.target_pos))
@@ -281,6 +318,14 @@ class ExampleGui(QMainWindow):
             "margin: 10 2px};"
         )
 
+        #setup label for the latency of the last stop
+        self.stop_lat = QLabel("")
+        self.stop_lat.setAlignment(QtCore.Qt.AlignCenter)
+        self.stop_lat.setStyleSheet(
+            "font-size: 16px;" +
+            "color: 'white';"
+        )
+
         #add gui widgets to layout
         grid.addWidget(self.plus, 0, 0, 1, 5)
         grid.addWidget(self.minus, 1, 0, 1, 5)
@@ -288,6 +333,7 @@ class ExampleGui(QMainWindow):
         grid.addWidget(self.pos, 1, 5, 1, 5)
         grid.addWidget(self.feed_ovr1, 2, 0, 1, 9)
         grid.addWidget(self.fdovr_val, 2, 9, 1, 1)
+        grid.addWidget(self.stop_lat, 3, 0, 1, 10)
 
         #connect signals to timer slots
         self.plus.pressed.connect(self.startTimer)
@@ -0,0 +1,53 @@
+import math
+import numpy as np
+import pytest
+from fcmcexpression import FCMCMapping, parseExpression
+
+
+def test_evaluate_in_output_order():
+    mapping = FCMCMapping(['X', 'Y'], [('a', '-X'), ('b', '2 * Y + 1')])
+
+    assert tuple(mapping.evaluate([3.0, 4.0])) == (-3.0, 9.0)
+    assert mapping.keys == ['a', 'b']
+
+
+def test_variables_in_dependency_order():
+    mapping = FCMCMapping(['A'], [('x', 'r * cos(t)'), ('y', 'r * sin(t)')],
+                          {'t': 'radians(A)', 'r': 'd / 2', 'd': '10'})
+
+    x, y = mapping.evaluate([90.0])
+    assert x == pytest.approx(0.0, abs=1e-12)
+    assert y == pytest.approx(5.0)
+
+
+def test_bulk_matches_scalar_evaluation():
+    mapping = FCMCMapping(['X', 'Y'], [('a', 'hypot(X, Y)'), ('b', 'atan2(Y, X)'), ('c', 'pi')])
+    values = np.array([[3.0, 4.0], [1.0, -1.0], [0.0, 2.0]])
+
+    bulk = mapping.evaluateBulk(values)
+
+    assert bulk.shape == (3, 3)
+    for row, expected in zip(bulk, values):
+        assert row == pytest.approx(mapping.evaluate(expected))
+    assert np.all(bulk[:, 2] == math.pi)
+
+
+def test_circular_variables_are_rejected():
+    with pytest.raises(ValueError, match='circular'):
+        FCMCMapping(['X'], [('a', 'u')], {'u': 'v + X', 'v': 'u'})
+
+
+def test_unknown_names_are_rejected():
+    with pytest.raises(ValueError, match='unknown name'):
+        FCMCMapping(['X'], [('a', 'X + Z')])
+
+
+def test_variable_must_not_shadow_input():
+    with pytest.raises(ValueError):
+        FCMCMapping(['X'], [('a', 'X')], {'X': '1'})
+
+
+@pytest.mark.parametrize('text', ['__import__("os")', 'X.real', '[X]', 'open(X)', 'lambda: 1', 'X +'])
+def test_unsafe_or_invalid_expressions_are_rejected(text):
+    with pytest.raises(ValueError):
+        parseExpression(text)
@@ -0,0 +1,90 @@
+import pytest
+from fcmcgcode import parseGcode
+
+
+def moves(*lines, **kwargs):
+    return list(parseGcode(lines, **kwargs))
+
+
+def test_absolute_and_incremental_distances():
+    result = moves('G90 G1 X10 Y5 F100', 'G91 X2', 'G90 Y0')
+
+    assert result[0]['end']['X'] == 10.0 and result[0]['end']['Y'] == 5.0
+    assert result[1]['end']['X'] == 12.0
+    assert result[2]['end']['Y'] == 0.0 and result[2]['end']['X'] == 12.0
+
+
+def test_moves_chain_start_and_end():
+    result = moves('G1 X10 F100', 'X20')
+
+    assert result[1]['start'] is result[0]['end']
+    assert result[1]['feed'] == 100.0
+
+
+def test_modal_motion_and_comments():
+    result = moves('G0 X5 (rapid)', 'X6 ; still rapid', '(comment only)', 'G1 X7 F50')
+
+    assert [move['motion'] for move in result] == [0, 0, 1]
+
+
+def test_inch_units_are_converted():
+    result = moves('G20 G1 X1 F10')
+
+    assert result[0]['end']['X'] == pytest.approx(25.4)
+    assert result[0]['feed'] == pytest.approx(254.0)
+
+
+def test_start_position():
+    result = moves('G91 G1 X1 F10', start={'X': 5.0})
+
+    assert result[0]['start']['X'] == 5.0 and result[0]['end']['X'] == 6.0
+
+
+@pytest.mark.parametrize('block', ['G4 P1.5', 'P1.5 G4'])
+def test_dwell_time_in_any_order(block):
+    assert moves(block) == [{'motion': 4, 'duration': 1.5, 'line': 1}]
+
+
+def test_arc_center_from_offsets():
+    result = moves('G1 X10 F100', 'G2 X20 I5 J0')
+
+    assert result[1]['center'] == (15.0, 0.0)
+    assert result[1]['plane'] == 17
+
+
+def test_arc_center_from_radius():
+    #half circle from (0, 0) to (10, 0): the center is in the middle of the chord
+    result = moves('G3 X10 Y0 R5 F100')
+
+    assert result[0]['center'] == pytest.approx((5.0, 0.0))
+
+
+def test_arc_radius_too_small():
+    with pytest.raises(ValueError):
+        moves('G2 X10 Y0 R4 F100')
+
+
+def test_arc_in_other_plane():
+    result = moves('G18 G2 Z10 X0 K5 F100')
+
+    assert result[0]['plane'] == 18
+    assert result[0]['center'] == (5.0, 0.0)
+
+
+def test_incremental_arc_center_mode_keeps_absolute_distances():
+    #G91.1 only changes the meaning of I, J, K, not the distance mode
+    result = moves('G90 G91.1 G17', 'G1 X10 Y0 F100', 'G1 X20')
+
+    assert result[-1]['end']['X'] == 20.0
+
+
+def test_absolute_arc_center_mode():
+    result = moves('G90.1', 'G1 X10 F100', 'G2 X20 I15 J0')
+
+    assert result[-1]['center'] == (15.0, 0.0)
+
+
+@pytest.mark.parametrize('code', ['G38.2', 'G17.1'])
+def test_unsupported_decimal_codes_are_rejected(code):
+    with pytest.raises(ValueError, match=code):
+        moves('G90', code + ' X10')
@@ -0,0 +1,52 @@
+from fcmckinematics import FCMCKinematics
+
+
+def config():
+    return {
+        'geoAxes': {'X': {'value': '0.0'}, 'A': {'value': '0.0'}},
+        'machAxes': {
+            'X1': {'docName': 'D', 'object': 'a', 'placementMode': 'quaternion',
+                   'placement': {'x': '0.0', 'y': '0.0', 'z': '0.0'}, 'quaternion': {'x': 0.0, 'y': 0.0, 'z': 0.0, 'w': 1.0}},
+            'A1': {'docName': 'D', 'object': 'b',
+                   'placement': {'x': '0.0', 'y': '0.0', 'z': '0.0'}, 'rotation': {'x': '0.0', 'y': '0.0', 'z': '1.0', 'angle': '0.0'}},
+        },
+        'transformations': {
+            'X1': {'placement': {'x': {'factor': '2.0', 'source': ['geoAxes', 'X', 'value']}}},
+            'A1': {'rotation': {'angle': {'factor': '1.0', 'source': ['geoAxes', 'A', 'value']}}},
+        },
+    }
+
+
+def held(angle, axis_z):
+    return {'A1': {'docName': 'D', 'object': 'b', 'placement': {'x': 0.0, 'y': 0.0, 'z': 0.0},
+                   'rotation': {'x': 0.0, 'y': 0.0, 'z': axis_z, 'angle': angle}}}
+
+
+def test_merge_negative_rotation_keeps_configured_axis():
+    kinematics = FCMCKinematics(config())
+
+    #FreeCAD reports -5 degrees about z as 5 degrees about -z
+    kinematics.mergeMachAxValues(held(5.0, -1.0))
+
+    assert kinematics.mach_axes['A1']['rotation'] == {'x': '0.0', 'y': '0.0', 'z': '1.0', 'angle': -5.0}
+
+    kinematics.calcAxValues("geoAxes")
+    assert kinematics.geo_axes['A']['value'] == -5.0
+
+
+def test_merge_positive_rotation():
+    kinematics = FCMCKinematics(config())
+    kinematics.mergeMachAxValues(held(5.0, 1.0))
+
+    assert kinematics.mach_axes['A1']['rotation']['angle'] == 5.0
+
+
+def test_merge_full_precision_mode_takes_values_over():
+    kinematics = FCMCKinematics(config())
+    quaternion = {'x': 0.0, 'y': 0.0, 'z': 0.5, 'w': 0.75 ** 0.5}
+    kinematics.mergeMachAxValues({'X1': {'placement': {'x': 4.0, 'y': 0.0, 'z': 0.0}, 'quaternion': quaternion}})
+
+    assert kinematics.mach_axes['X1']['quaternion'] == quaternion
+
+    kinematics.calcAxValues("geoAxes")
+    assert kinematics.geo_axes['X']['value'] == 2.0
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from fcmclimits import FCMCLimits, FCMCLimitError
+
+
+def axes(x=0.0, limits=None):
+    return {'X1': {'docName': 'D', 'object': 'a', 'placement': {'x': x, 'y': 0.0, 'z': 0.0},
+                   'limits': limits if limits is not None else {'placement.x': {'min': '-100', 'max': '0', 'vel': '50', 'acc': '500'}}}}
+
+
+def kinds(violations):
+    return sorted(v['kind'] for v in violations)
+
+
+def test_without_limits_nothing_is_checked():
+    assert not FCMCLimits(axes(limits={}))
+
+
+def test_position_limits():
+    limits = FCMCLimits(axes())
+
+    assert limits.check(axes(-10.0), 0.0) == []
+    assert kinds(FCMCLimits(axes()).check(axes(5.0), 0.0)) == ['max']
+    assert kinds(FCMCLimits(axes()).check(axes(-150.0), 0.0)) == ['min']
+
+
+def test_velocity_against_last_accepted_setpoint():
+    limits = FCMCLimits(axes())
+    limits.check(axes(-10.0), 0.0)
+
+    violations = limits.check(axes(-20.0), 0.1)
+    assert kinds(violations) == ['vel']
+    assert violations[0]['value'] == pytest.approx(-100.0)
+
+    #the rejected setpoint is not remembered
+    assert limits.check(axes(-14.0), 0.1) == []
+
+
+def test_reset_forgets_the_history():
+    limits = FCMCLimits(axes())
+    limits.check(axes(-10.0), 0.0)
+    limits.reset()
+
+    assert limits.check(axes(-90.0), 0.1) == []
+
+
+def test_trajectory_reports_the_index_of_every_violation():
+    limits = FCMCLimits(axes())
+    values = np.array([[-1.0], [-2.0], [-200.0]])
+
+    violations = limits.checkTrajectory(values, [0.0, 0.1, 0.2])
+
+    assert {(v['kind'], v['index']) for v in violations} == {('min', 2), ('vel', 2), ('acc', 2)}
+
+
+def test_trajectory_columns_by_keys():
+    limits = FCMCLimits(axes())
+    keys = [('Y1', 'placement', 'z'), ('X1', 'placement', 'x')]
+
+    violations = limits.checkTrajectory(np.array([[1000.0, 5.0]]), None, keys)
+
+    assert [(v['axis'], v['kind']) for v in violations] == [('X1', 'max')]
+
+
+def test_limit_error_carries_the_violations():
+    violations = FCMCLimits(axes()).check(axes(5.0), 0.0)
+    error = FCMCLimitError(violations)
+
+    assert error.violations is violations
+    assert 'X1.placement.x max' in str(error)